@@ -0,0 +1,297 @@
+"""
+Build benchmark: time pandocmk on synthetic documents of increasing size
+
+Generates markdown documents that vary in
+
+- number of words,
+- number of media blocks (table, figure, figures, stlog) handled by filters/media.py,
+- number of citations, and
+- style,
+
+and times, for each of them:
+
+- options: get_pandoc_options() (style lookup, metadata file)
+- media_filter: filters/media.py on the JSON AST of the document (Pandoc runs only once, beforehand), without its memo (cold)
+- media_filter_memo: same, with the memo filled by a previous run (warm)
+- tex: the .tex output (Pandoc plus filters), without the build cache
+- build: the full build_output(), without the build cache (skipped if the PDF engine is not installed)
+
+Results are written as JSON, so they can be compared across releases.
+
+Usage:
+
+    python benchmarks/builds.py [--words=1000,10000] [--media=0,20] [--citations=0,20] [--styles=default,paper] [--repeat=N] [--output=FILE]
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import struct
+import argparse
+import platform
+import statistics
+import contextlib
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from pandocmk.version import __version__
+from pandocmk.metadata import get_pandoc_options, options2arguments
+
+
+# ---------------------------
+# Synthetic documents
+# ---------------------------
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt '
+         'ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation').split()
+MEDIA_TAGS = ('table', 'figure', 'figures', 'stlog')
+WORDS_PER_PARAGRAPH = 100
+PARAGRAPHS_PER_SECTION = 5
+
+
+def tiny_png():
+    '''A valid 1x1 white PNG, so \\includegraphics has something to include'''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    header = struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(b'\x00\xff\xff\xff')) + chunk(b'IEND', b'')
+
+
+def media_block(tag, i):
+    '''YAML code block handled by filters/media.py, with its source files'''
+    files = {}
+    if tag == 'table':
+        files[f'media/table{i}.tex'] = 'a & b \\\\\n1 & 2 \\\\\n'
+        lines = [f'title: Results *{i}*', f'subtitle: Subtitle of table {i}', 'note: Standard errors in **parentheses**.', f'source: media/table{i}.tex']
+    elif tag == 'figure':
+        files[f'media/figure{i}.png'] = tiny_png()
+        lines = [f'title: Figure *{i}*', "note: 'Source: own calculations.'", f'source: media/figure{i}.png']
+    elif tag == 'figures':
+        lines = [f'title: Panels *{i}*', 'content:']
+        for panel in 'ab':
+            files[f'media/figures{i}{panel}.png'] = tiny_png()
+            lines.extend([f'  - title: Panel {panel}', f'    source: media/figures{i}{panel}.png'])
+    else:
+        files[f'media/stlog{i}.log'] = '. regress y x\n'
+        lines = [f'title: Log *{i}*', f'source: media/stlog{i}.log']
+    return ['~~~ ' + tag] + lines + ['~~~'], files
+
+
+def make_document(folder, words, media, citations, style):
+    '''Write doc.md (and its media and bibliography files) to the folder; return its path'''
+    num_paragraphs = max(1, words // WORDS_PER_PARAGRAPH)
+    media_every = num_paragraphs / media if media else None
+    cite_every = num_paragraphs / citations if citations else None
+
+    lines = ['---', f'style: {style}', 'title: Synthetic benchmark document']
+    if citations:
+        lines.append('bibliography: refs.bib')
+    lines.extend(['---', ''])
+
+    files = {}
+    num_media = num_cites = 0
+    for p in range(num_paragraphs):
+        if p % PARAGRAPHS_PER_SECTION == 0:
+            lines.extend([f'# Section {p // PARAGRAPHS_PER_SECTION + 1}', ''])
+
+        text = ' '.join(WORDS[(p + j) % len(WORDS)] for j in range(WORDS_PER_PARAGRAPH)) + '.'
+        while cite_every and num_cites < citations and num_cites * cite_every <= p:
+            num_cites += 1
+            text += f' See [@ref{num_cites}].'
+        lines.extend([text, ''])
+
+        while media_every and num_media < media and num_media * media_every <= p:
+            num_media += 1
+            block, block_files = media_block(MEDIA_TAGS[num_media % len(MEDIA_TAGS)], num_media)
+            lines.extend(block + [''])
+            files.update(block_files)
+
+    lines.extend(['::: {#backmatter}', ':::', ''])
+
+    if citations:
+        entries = [f'@article{{ref{i},\n  author = {{Doe, Jane{i}}},\n  title = {{Paper {i}}},\n  journal = {{Journal}},\n  year = {{{2000 + i % 25}}}\n}}\n'
+                   for i in range(1, citations + 1)]
+        files['refs.bib'] = '\n'.join(entries)
+
+    folder.mkdir(parents=True, exist_ok=True)
+    for fn, content in files.items():
+        path = folder / fn
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, bytes):
+            path.write_bytes(content)
+        else:
+            path.write_text(content, encoding='utf8')
+
+    md_fn = folder / 'doc.md'
+    md_fn.write_text('\n'.join(lines), encoding='utf8')
+    return md_fn
+
+
+# ---------------------------
+# Timing
+# ---------------------------
+
+def measure(func, repeat):
+    '''Run func() repeat times; return its timings (in seconds) or the error that stopped it'''
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                func()
+        except (Exception, SystemExit) as e:
+            return {'error': f'{type(e).__name__}: {str(e).strip()[:500]}'}
+        times.append(time.perf_counter() - tic)
+    return {'min': min(times), 'median': statistics.median(times), 'runs': times}
+
+
+def media_filter_timer(pandoc_options, md_fn):
+    '''Time filters/media.py alone: parse the document once, and run the filter on a fresh copy each time'''
+    import panflute as pf
+    from pandocmk.pipeline import load_filter
+
+    filters = [fn for fn in pandoc_options.get('filter', []) if Path(fn).name == 'media.py']
+    if not filters:
+        return None
+    module = load_filter(filters[0])
+
+    # Metadata (including the style's) is part of the AST, as when the filter runs within Pandoc
+    options = {k: v for k, v in pandoc_options.items() if k not in ('filter', 'lua-filter', 'citeproc', 'output')}
+    options['to'] = 'json'
+    cmd = ['pandoc', *options2arguments(options), str(md_fn)]
+    ast = subprocess.run(cmd, capture_output=True, text=True, encoding='utf8', check=True).stdout
+
+    def run():
+        doc = pf.load(io.StringIO(ast))
+        doc.format = pandoc_options.get('to', 'latex')
+        module.main(doc)
+
+    return run
+
+
+@contextlib.contextmanager
+def environ(**variables):
+    old = {k: os.environ.get(k) for k in variables}
+    os.environ.update({k: v for k, v in variables.items() if v is not None})
+    for k, v in variables.items():
+        if v is None:
+            os.environ.pop(k, None)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def run_case(folder, words, media, citations, style, repeat):
+    from pandocmk.core import build_output, run_pandoc
+
+    md_fn = make_document(folder, words, media, citations, style)
+    result = {'words': words, 'media': media, 'citations': citations, 'style': style}
+
+    # Media files are referenced with relative paths, as in any document
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        result['options'] = measure(lambda: get_pandoc_options([], md_fn), repeat)
+        with contextlib.redirect_stdout(io.StringIO()):
+            pandoc_options = get_pandoc_options([], md_fn)
+
+        try:
+            run = media_filter_timer(pandoc_options, md_fn)
+        except (subprocess.CalledProcessError, OSError) as e:
+            run = None
+            result['media_filter'] = {'error': f'{type(e).__name__}: {str(e).strip()[:500]}'}
+        if run is not None:
+            with environ(PANDOCMK_NO_CACHE='1'):
+                result['media_filter'] = measure(run, repeat)
+            run() # Fill the memo
+            result['media_filter_memo'] = measure(run, repeat)
+
+        result['tex'] = measure(lambda: run_pandoc(dict(pandoc_options), md_fn, 'tex', verbose=False), repeat)
+
+        pdf_engine = pandoc_options.get('pdf-engine', 'xelatex')
+        if shutil.which(pdf_engine):
+            build = lambda: build_output(md_fn, view=False, timeit=False, tex=False, latexmk=False, verbose=False, pandoc_options=dict(pandoc_options), cache=False)
+            result['build'] = measure(build, repeat)
+        else:
+            result['build'] = {'skipped': f'{pdf_engine} not found'}
+    finally:
+        os.chdir(cwd)
+
+    return result
+
+
+def get_versions():
+    try:
+        pandoc = subprocess.run(['pandoc', '--version'], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        pandoc = None
+    return {'pandocmk': __version__, 'pandoc': pandoc, 'python': platform.python_version(), 'platform': platform.platform()}
+
+
+# ---------------------------
+# Main
+# ---------------------------
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time pandocmk builds of synthetic documents')
+    parser.add_argument('--words', type=int_list, default=[1000, 10000], help='comma-separated word counts')
+    parser.add_argument('--media', type=int_list, default=[0, 20], help='comma-separated number of media blocks')
+    parser.add_argument('--citations', type=int_list, default=[0, 20], help='comma-separated number of citations')
+    parser.add_argument('--styles', type=lambda x: x.split(','), default=['default', 'paper'], help='comma-separated styles')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each step')
+    parser.add_argument('--output', '-o', default=None, help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the generated documents')
+    args = parser.parse_args()
+
+    # Scratch folder for the documents, their metadata files and the caches, so the user's cache is not touched
+    import tempfile
+    scratch = Path(tempfile.mkdtemp(prefix='pandocmk-bench-'))
+
+    results = []
+    try:
+        with environ(PANDOCMK_CACHE=str(scratch / 'cache'), PANDOCMK_NO_CACHE=None, PANDOCMK_TRACE=None):
+            for style in args.styles:
+                for words in args.words:
+                    for media in args.media:
+                        for citations in args.citations:
+                            folder = scratch / f'{style}-{words}w-{media}m-{citations}c'
+                            print(f'[pandocmk] benchmark {folder.name}', file=sys.stderr)
+                            results.append(run_case(folder, words, media, citations, style, args.repeat))
+    finally:
+        if args.keep:
+            print(f'[pandocmk] documents kept in "{scratch}"', file=sys.stderr)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    data = {'versions': get_versions(), 'repeat': args.repeat, 'results': results}
+    text = json.dumps(data, indent=2)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf8')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
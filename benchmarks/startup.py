@@ -0,0 +1,82 @@
+"""
+Startup benchmark: import time of the pandocmk CLI
+
+Runs "python -X importtime" in a fresh interpreter and fails (exit code 1) if
+
+- importing the CLI (what "pandocmk --version" and "pandocmk --help" need) or the daemon client takes longer than the budget, or
+- the CLI imports modules that are only needed by some builds (panflute, watchdog, etc.)
+
+Usage:
+
+    python benchmarks/startup.py [--budget=MILLISECONDS] [--repeat=N]
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# (module imported by the benchmark, import-time budget in ms, modules it must not import)
+CASES = [
+    ('pandocmk', 5, ['click', 'yaml', 'panflute', 'watchdog', 'backoff']),
+    ('pandocmk.daemon', 30, ['click', 'yaml', 'panflute', 'watchdog', 'backoff', 'concurrent.futures']),
+    ('pandocmk.cli', 100, ['yaml', 'panflute', 'watchdog', 'backoff', 'urllib.request', 'concurrent.futures']),
+    ('pandocmk.batch', 150, ['panflute', 'watchdog', 'backoff', 'urllib.request', 'concurrent.futures']),
+]
+
+
+def import_time(module):
+    '''Return the cumulative import time of a module (in ms) and the set of all imported modules'''
+    cmd = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True, check=True)
+
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1000
+    return times[module], set(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of pandocmk')
+    parser.add_argument('--budget', type=float, default=None, help='override the budget of the pandocmk.cli import (ms)')
+    parser.add_argument('--repeat', type=int, default=5, help='take the best of N runs')
+    args = parser.parse_args()
+
+    ok = True
+    for module, budget, forbidden in CASES:
+        if args.budget is not None and module == 'pandocmk.cli':
+            budget = args.budget
+
+        best = float('inf')
+        for _ in range(args.repeat):
+            elapsed, imported = import_time(module)
+            best = min(best, elapsed)
+
+        unexpected = sorted(m for m in forbidden if m in imported)
+        passed = best <= budget and not unexpected
+        ok = ok and passed
+        print(f'{"OK  " if passed else "FAIL"} import {module:<16} {best:7.1f} ms (budget {budget} ms)')
+        if unexpected:
+            print(f'     unexpected imports: {", ".join(unexpected)}')
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
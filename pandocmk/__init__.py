@@ -4,5 +4,13 @@ Pandocmk: A minimalistic make for pandoc
 
 """
 
-from .cli import main
 from .version import __version__
+
+
+def __getattr__(name):
+    # Import the CLI (and its dependencies) only when it is used
+    # (the "pandocmk" console script calls pandocmk:main, which first tries to forward the command to a daemon)
+    if name == 'main':
+        from .daemon import main
+        return main
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
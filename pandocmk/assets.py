@@ -0,0 +1,324 @@
+"""
+Code for preprocessing the images of figures (used by filters/media.py)
+
+- SVG files are converted to PDF (with cairosvg, rsvg-convert or inkscape), so LaTeX can include them
+- If a target resolution is set (metadata "media-dpi"), PNG and JPEG files with more pixels than needed
+  for their width in the document are downsampled and recompressed (requires Pillow)
+- If externalization is enabled (metadata "media-tikz-external"), TikZ figures are compiled
+  into standalone PDFs, so the document doesn't recompile them in every LaTeX pass
+
+Converted files are stored in the cache folder, named after the hash of their input and settings
+(for TikZ figures, also of the files they \input and the data files they plot),
+and conversions run in parallel in a single process pool. The .tex doesn't point into the cache,
+which evicts old files: converted files are linked (or copied) into ./tmp/assets, and outputs
+fetched from the build cache are only used if the files they include are still there (see has_missing_assets()).
+
+Messages go to stderr, as the filter sends the document to Pandoc through stdout.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import re
+import sys
+import json
+import shutil
+import functools
+import subprocess
+from pathlib import Path
+
+from .cache import BuildCache
+from .trace import span
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+RASTER_SUFFIXES = ('.png', '.jpg', '.jpeg')
+DEFAULT_TEXTWIDTH = 6.5 # Inches (letter paper with one-inch margins)
+DEFAULT_QUALITY = 85 # JPEG quality of downsampled images
+ASSETS_MAX_SIZE = 1024 * 2 ** 20 # Bytes
+
+DEFAULT_TIKZ_ENGINE = 'pdflatex'
+DEFAULT_TIKZ_PREAMBLE = r'\usepackage{tikz}'
+TIKZ_TEMPLATE = r'''\documentclass[border=0pt]{{standalone}}
+{preamble}
+\begin{{document}}
+\input{{"{source}"}}
+\end{{document}}
+'''
+
+# Files read by TikZ figures: \input and graphics, and the data of pgfplots ("\addplot table {data.csv}")
+TIKZ_INPUT_REGEX = re.compile(r'\\(input|include|includegraphics|pgfplotstableread)\s*(?:\[[^\]]*\])?\s*\{\s*"?([^}"]+)"?\s*\}')
+TIKZ_TABLE_REGEX = re.compile(r'\b(?:table|file)\s*(?:\[[^\]]*\])?\s*\{\s*"?([^}"\\]+)"?\s*\}')
+TIKZ_GRAPHICS_SUFFIXES = ('.pdf', '.png', '.jpg', '.jpeg', '.eps')
+
+# Folder of the converted files included by the .tex (relative to the current folder, as the sources of figures)
+LOCAL_ASSETS_PATH = Path('tmp') / 'assets'
+LOCAL_ASSET_REGEX = re.compile(r'tmp/assets/[0-9a-f]{64}\.[a-z]+')
+
+
+def get_asset_cache():
+    root = os.environ.get('PANDOCMK_CACHE') or (Path.home() / '.cache' / 'pandocmk')
+    return BuildCache(Path(root) / 'assets', max_size=ASSETS_MAX_SIZE)
+
+
+def prepare_media(requests=(), sources=(), dpi=None, textwidth=DEFAULT_TEXTWIDTH, quality=DEFAULT_QUALITY,
+                  preamble=DEFAULT_TIKZ_PREAMBLE, engine=DEFAULT_TIKZ_ENGINE, jobs=None, verbose=False):
+    '''
+    Preprocess images and compile TikZ figures (in the same process pool); return the results of
+    prepare_assets() and prepare_tikz() as a pair of dicts
+    '''
+    image_plans = {(source, size): plan_asset(source, size, dpi=dpi, textwidth=textwidth, quality=quality)
+                   for source, size in dict.fromkeys(requests)}
+    tikz_plans = {('tikz', source): plan_tikz(source, preamble=preamble, engine=engine) for source in dict.fromkeys(sources)}
+    paths = run_plans({**image_plans, **tikz_plans}, jobs=jobs, verbose=verbose)
+    return {k: link_asset(paths[k]) if paths[k] else k[0] for k in image_plans}, {k[1]: paths[k] and link_asset(paths[k]) for k in tikz_plans}
+
+
+def prepare_assets(requests, dpi=None, textwidth=DEFAULT_TEXTWIDTH, quality=DEFAULT_QUALITY, jobs=None, verbose=False):
+    '''
+    Preprocess the images of figures; return a dict from (source, size) to the file LaTeX should include
+
+    -requests- are (source, size) pairs, with size the width of the image as a fraction of the text width.
+    Files that need no processing (or can't be processed) map to themselves.
+    '''
+    return prepare_media(requests, dpi=dpi, textwidth=textwidth, quality=quality, jobs=jobs, verbose=verbose)[0]
+
+
+def prepare_tikz(sources, preamble=DEFAULT_TIKZ_PREAMBLE, engine=DEFAULT_TIKZ_ENGINE, jobs=None, verbose=False):
+    '''
+    Compile TikZ sources into standalone PDFs; return a dict from each source to its PDF
+
+    Sources that can't be compiled map to None, so they can be included with \\input as usual
+    '''
+    return prepare_media(sources=sources, preamble=preamble, engine=engine, jobs=jobs, verbose=verbose)[1]
+
+
+def run_plans(plans, jobs=None, verbose=False):
+    '''Run the conversions missing from the cache (in a process pool); return a dict from each request to its output file'''
+    cache = get_asset_cache()
+    rebuild = bool(os.environ.get('PANDOCMK_NO_CACHE'))
+
+    paths = {}
+    tasks = {}
+    for request, task in plans.items():
+        paths[request] = None
+        if task is None:
+            continue
+        tools = [task['engine']] if task['action'] == 'tikz' else [] # A new TeX distribution can change the PDF
+        key = cache.key('asset', [json.dumps(task, sort_keys=True)], [task['source']] + task.get('inputs', []), tools=tools)
+        out_fn = cache.path / (key + task['suffix'])
+        paths[request] = out_fn.as_posix()
+        if rebuild or not out_fn.is_file():
+            tasks[out_fn] = task
+        else:
+            os.utime(out_fn) # Mark as recently used
+
+    if not tasks:
+        return paths
+
+    with span('assets', num_files=len(tasks)):
+        # Starting a pool only pays off with several files
+        if len(tasks) == 1:
+            results = [convert_asset(task, out_fn) for out_fn, task in tasks.items()]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(convert_asset, tasks.values(), tasks.keys()))
+
+    failed = set()
+    for (out_fn, task), error in zip(tasks.items(), results):
+        if error:
+            print(f'[pandocmk] Warning! could not convert "{task["source"]}": {error}', file=sys.stderr)
+            failed.add(out_fn.as_posix())
+        elif verbose:
+            print(f'[pandocmk] converted "{task["source"]}" -> "{out_fn}"', file=sys.stderr)
+
+    cache.evict()
+    return {k: (None if v in failed else v) for k, v in paths.items()}
+
+
+def link_asset(cache_fn):
+    '''Hard link (or copy) a converted file from the cache into LOCAL_ASSETS_PATH; return its path there'''
+    local_fn = LOCAL_ASSETS_PATH / Path(cache_fn).name
+    if local_fn.is_file() and not os.environ.get('PANDOCMK_NO_CACHE'):
+        return local_fn.as_posix()
+
+    LOCAL_ASSETS_PATH.mkdir(parents=True, exist_ok=True)
+    tmp_fn = local_fn.with_name(f'{local_fn.name}.{os.getpid()}.tmp') # Readers never see a partial file
+    try:
+        os.link(cache_fn, tmp_fn)
+    except OSError: # e.g. the cache is in another file system
+        shutil.copyfile(cache_fn, tmp_fn)
+    os.replace(tmp_fn, local_fn)
+    return local_fn.as_posix()
+
+
+def has_missing_assets(fn):
+    '''Whether a .tex output (e.g. from the build cache) includes converted files that are gone (e.g. ./tmp was deleted)'''
+    try:
+        text = Path(fn).read_text(encoding='utf8', errors='replace')
+    except OSError:
+        return False
+    return any(not Path(match).is_file() for match in set(LOCAL_ASSET_REGEX.findall(text)))
+
+
+def plan_asset(source, size, dpi, textwidth, quality):
+    '''Return the conversion needed by an image (as a dict of settings), or None if there is none'''
+    path = Path(source)
+    suffix = path.suffix.lower()
+    if not path.is_file():
+        return None
+
+    if suffix == '.svg':
+        converter = get_svg_converter()
+        if converter is None:
+            print(f'[pandocmk] Warning! cannot convert "{source}" to PDF; install cairosvg, rsvg-convert or inkscape', file=sys.stderr)
+            return None
+        return {'source': source, 'action': 'svg', 'converter': converter, 'suffix': '.pdf'}
+
+    if suffix in RASTER_SUFFIXES and dpi:
+        try:
+            from PIL import Image
+        except ImportError:
+            print('[pandocmk] Warning! media-dpi requires Pillow (pip install pillow)', file=sys.stderr)
+            return None
+        try:
+            size = float(size)
+        except (TypeError, ValueError):
+            size = 1.0 # e.g. "size: 5" of tables
+        width = round(min(size, 1.0) * textwidth * float(dpi))
+        try:
+            with Image.open(source) as image: # Only reads the header
+                if image.width <= width:
+                    return None
+        except OSError:
+            return None # Let LaTeX complain about it
+        return {'source': source, 'action': 'raster', 'width': width, 'quality': quality, 'suffix': suffix}
+
+    return None
+
+
+def plan_tikz(source, preamble, engine):
+    if not Path(source).is_file():
+        return None
+    if not shutil.which(engine):
+        print(f'[pandocmk] Warning! cannot externalize "{source}": {engine} not found', file=sys.stderr)
+        return None
+    return {'source': source, 'action': 'tikz', 'preamble': preamble, 'engine': engine, 'suffix': '.pdf',
+            'inputs': find_tikz_inputs(source)}
+
+
+def find_tikz_inputs(source, seen=None):
+    '''List the files a TikZ figure reads (recursively through \\input), found from the current folder as LaTeX does'''
+    seen = set() if seen is None else seen
+    try:
+        text = Path(source).read_text(encoding='utf8', errors='replace')
+    except OSError:
+        return []
+    text = re.sub(r'(?<!\\)%.*', '', text) # Comments
+
+    inputs = []
+    for command, name in TIKZ_INPUT_REGEX.findall(text):
+        suffixes = {'includegraphics': TIKZ_GRAPHICS_SUFFIXES, 'pgfplotstableread': ()}.get(command, ('.tex',))
+        inputs.append(find_latex_file(name.strip(), suffixes))
+    inputs.extend(find_latex_file(name.strip(), ()) for name in TIKZ_TABLE_REGEX.findall(text))
+
+    found = []
+    for fn in inputs:
+        if fn in seen:
+            continue
+        seen.add(fn)
+        found.append(fn)
+        if fn.endswith('.tex'):
+            found.extend(find_tikz_inputs(fn, seen))
+    return found
+
+
+def find_latex_file(name, suffixes):
+    '''LaTeX adds the suffix if needed (missing files are still listed, so creating them invalidates the cache)'''
+    if Path(name).suffix.lower() in suffixes or not suffixes or Path(name).is_file():
+        return name
+    for suffix in suffixes:
+        if Path(name + suffix).is_file():
+            return name + suffix
+    return name + suffixes[0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_svg_converter():
+    try:
+        import cairosvg
+        return 'cairosvg'
+    except (ImportError, OSError): # OSError if the cairo library is missing
+        pass
+    for converter in ('rsvg-convert', 'inkscape'):
+        if shutil.which(converter):
+            return converter
+    return None
+
+
+def convert_asset(task, out_fn):
+    '''Convert an image (in a worker process); return an error message, or None if it succeeded'''
+    out_fn = Path(out_fn)
+    tmp_fn = out_fn.with_name(f'{out_fn.name}.{os.getpid()}.tmp') # Readers never see a partial file
+    try:
+        if task['action'] == 'svg':
+            convert_svg(task['source'], tmp_fn, task['converter'])
+        elif task['action'] == 'tikz':
+            compile_tikz(task['source'], tmp_fn, task['preamble'], task['engine'])
+        else:
+            resize_raster(task['source'], tmp_fn, task['width'], task['quality'])
+        os.replace(tmp_fn, out_fn)
+    except Exception as e:
+        Path(tmp_fn).unlink(missing_ok=True)
+        return str(e).strip() or type(e).__name__
+    return None
+
+
+def convert_svg(source, out_fn, converter):
+    if converter == 'cairosvg':
+        import cairosvg
+        cairosvg.svg2pdf(url=str(source), write_to=str(out_fn))
+        return
+
+    if converter == 'rsvg-convert':
+        cmd = ['rsvg-convert', '--format=pdf', f'--output={out_fn}', str(source)]
+    else:
+        cmd = ['inkscape', '--export-type=pdf', f'--export-filename={out_fn}', str(source)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise IOError(proc.stderr or f'{converter} failed with exit code {proc.returncode}')
+
+
+def resize_raster(source, out_fn, width, quality):
+    from PIL import Image
+
+    with Image.open(source) as image:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+        if Path(source).suffix.lower() == '.png':
+            image.save(out_fn, format='PNG', optimize=True)
+        else:
+            image.convert('RGB').save(out_fn, format='JPEG', quality=quality, optimize=True)
+
+
+def compile_tikz(source, out_fn, preamble, engine):
+    '''Compile a TikZ picture into a PDF cropped to its size (files it inputs are found from the current folder)'''
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix='pandocmk-tikz-') as tmp_path:
+        tex_fn = Path(tmp_path) / 'figure.tex'
+        tex_fn.write_text(TIKZ_TEMPLATE.format(preamble=preamble, source=Path(source).as_posix()), encoding='utf8')
+        cmd = [engine, '-interaction=nonstopmode', '-halt-on-error', f'-output-directory={tmp_path}', str(tex_fn)]
+        proc = subprocess.run(cmd, capture_output=True, text=True, errors='replace')
+        if proc.returncode != 0:
+            # Show the LaTeX error (lines starting with "!") instead of the whole log
+            errors = [line for line in proc.stdout.splitlines() if line.startswith('!')]
+            raise IOError('\n'.join(errors) or f'{engine} failed with exit code {proc.returncode}')
+        shutil.move(str(tex_fn.with_suffix('.pdf')), str(out_fn))
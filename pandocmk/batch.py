@@ -0,0 +1,182 @@
+"""
+Code for building several documents, optionally in parallel
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import glob
+import time
+from pathlib import Path
+
+from .metadata import get_pandoc_options
+from .core import build_output
+from .draft import apply_draft_options
+from .errors import classify_error
+from .process import BuildCancelled
+from . import trace
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Pandoc options whose value is a path; we read "--opt value" as "--opt=value", so the value isn't taken for an input
+PATH_OPTIONS = ('--output', '--template', '--reference-doc', '--data-dir', '--resource-path', '--extract-media',
+                '--filter', '--lua-filter', '--bibliography', '--csl', '--citation-abbreviations', '--metadata-file',
+                '--defaults', '--include-in-header', '--include-before-body', '--include-after-body',
+                '--syntax-definition', '--epub-cover-image', '--log')
+
+# Path options whose value is written, so it doesn't exist yet
+OUTPUT_OPTIONS = ('--output', '--extract-media', '--log')
+
+
+def join_option_values(args):
+    '''Merge "--opt value" pairs of path options (see PATH_OPTIONS) into "--opt=value"'''
+    joined = []
+    for arg in args:
+        if joined and joined[-1] in PATH_OPTIONS and not arg.startswith('-'):
+            joined[-1] = f'{joined[-1]}={arg}'
+        else:
+            joined.append(arg)
+    return joined
+
+
+def resolve_option_paths(args):
+    '''
+    Make the values of path options absolute, for builds that run in the folder of each document (see watchtree.py)
+
+    Values that aren't existing paths are kept as they are, as Pandoc also looks for them elsewhere
+    (e.g. filters in PATH, templates in the data folder)
+    '''
+    resolved = []
+    for arg in args:
+        option, equals, value = arg.partition('=')
+        if equals and option in PATH_OPTIONS:
+            values = value.split(os.pathsep) if option == '--resource-path' else [value]
+            values = [str(Path(v).resolve()) if v and (option in OUTPUT_OPTIONS or Path(v).exists()) else v for v in values]
+            arg = f'{option}={os.pathsep.join(values)}'
+        resolved.append(arg)
+    return resolved
+
+
+def split_arguments(args):
+    '''Separate input files (and globs) from the arguments forwarded to Pandoc'''
+    files = []
+    pandoc_args = []
+    for arg in join_option_values(args):
+        if arg.startswith('-'):
+            pandoc_args.append(arg)
+            continue
+        # Expand globs ourselves, as not every shell does it for us (e.g. cmd.exe)
+        matches = sorted(glob.glob(arg)) if glob.has_magic(arg) else [arg]
+        if not matches:
+            raise SystemExit(f'[pandocmk] Error! no files match "{arg}"')
+        files.extend(Path(fn) for fn in matches)
+
+    for fn in files:
+        if not fn.is_file():
+            raise SystemExit(f'[pandocmk] Error! file "{fn}" not found')
+        if fn.suffix != '.md':
+            raise SystemExit(f'[pandocmk] Error! file "{fn}" is not a markdown (.md) file')
+
+    # Remove duplicates but keep order
+    files = list(dict.fromkeys(files))
+    return files, pandoc_args
+
+
+def build_file(md_fn, pandoc_args, strict, retry, verbose, build=build_output, draft=False, **kwargs):
+    '''Resolve the Pandoc options of a single document and build it'''
+
+    # Get Pandoc options from CLI and YAML
+    # This also creates a temporary {filename}.yaml file with metadata based on styles
+    with trace.span('options', file=md_fn):
+        pandoc_options = get_pandoc_options(pandoc_args, md_fn, verbose=verbose, strict=strict)
+    if draft:
+        apply_draft_options(pandoc_options, md_fn, verbose=verbose)
+
+    # Optionally retry builds that fail with transient errors (see errors.py)
+    if retry:
+        build = retry_on_transient_errors(build, md_fn)
+
+    with trace.span('build', file=md_fn):
+        build(md_fn, verbose=verbose, pandoc_options=pandoc_options, draft=draft, **kwargs)
+
+
+def run_job(md_fn, **kwargs):
+    '''Wrapper around build_file() that reports errors instead of raising them (and trace events of workers)'''
+    num_events = len(trace.get_events()) # Pool processes run several jobs
+    started = time.time()
+    try:
+        build_file(md_fn, **kwargs)
+        error = None
+    except (Exception, SystemExit) as e:
+        error = classify_error(e, md_fn, since=started).message
+    return error, trace.get_events()[num_events:]
+
+
+def build_files(files, jobs, **kwargs):
+    '''Build several documents with a pool of -jobs- processes; return the number of failures'''
+
+    tic = time.perf_counter()
+    errors = {}
+
+    if jobs <= 1:
+        for md_fn in files:
+            errors[md_fn], _ = run_job(md_fn, **kwargs)
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(run_job, md_fn, **kwargs): md_fn for md_fn in files}
+            for future in as_completed(futures):
+                errors[futures[future]], events = future.result()
+                trace.add_events(events)
+
+    toc = time.perf_counter()
+    print_summary(files, errors, toc - tic)
+    return sum(error is not None for error in errors.values())
+
+
+def print_summary(files, errors, elapsed):
+    num_failed = sum(error is not None for error in errors.values())
+    print(f'[pandocmk] {len(files) - num_failed} of {len(files)} files built in {elapsed:0.1f} seconds')
+    for md_fn in files:
+        if errors[md_fn] is not None:
+            print(f'    FAILED {md_fn}: {errors[md_fn]}')
+
+
+def retry_on_transient_errors(build, md_fn):
+    '''Retry -build- with exponential backoff while it fails with transient errors; stop at the first deterministic one'''
+    import backoff
+    attempt = {}
+
+    def run(*args, **kwargs):
+        attempt['started'] = time.time()
+        return build(*args, **kwargs)
+
+    def error_is_fatal(e):
+        return not classify_error(e, md_fn, since=attempt['started']).transient
+
+    def print_backoff(details):
+        error = classify_error(details['exception'], md_fn, since=attempt['started'])
+        print(f'[pandocmk] {error.message}; retrying in {details["wait"]:0.1f} seconds (attempt {details["tries"]})')
+
+    # https://github.com/litl/backoff/blob/master/backoff/_wait_gen.py
+    run_with_retries = backoff.on_exception(wait_gen=backoff.expo, exception=Exception,
+                                            base=1, max_value=20,
+                                            max_tries=1000, max_time=600, giveup=error_is_fatal, on_backoff=print_backoff)(run)
+
+    def build_with_retries(*args, **kwargs):
+        try:
+            return run_with_retries(*args, **kwargs)
+        except BuildCancelled:
+            raise
+        except Exception as e:
+            # Show a one-line diagnostic instead of a traceback
+            error = classify_error(e, md_fn, since=attempt['started'])
+            raise SystemExit(f'[pandocmk] Error! {error.message}') from e
+
+    return build_with_retries
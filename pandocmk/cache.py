@@ -0,0 +1,95 @@
+"""
+Content-addressed cache of build outputs (.tex and .pdf files)
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import shutil
+import hashlib
+from pathlib import Path
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'pandocmk'
+DEFAULT_MAX_SIZE = 512 * 2 ** 20  # Bytes
+
+
+def hash_inputs(stage, args, paths):
+    '''Hash of a build stage: its name, its arguments and the content of every file it reads'''
+    h = hashlib.sha256()
+    h.update(stage.encode('utf8'))
+    for arg in args:
+        h.update(b'\0' + str(arg).encode('utf8'))
+    for fn in paths:
+        fn = Path(fn)
+        h.update(b'\0' + str(fn).encode('utf8') + b'\0')
+        if fn.is_file():
+            h.update(fn.read_bytes())
+        else:
+            h.update(b'<missing>')
+    return h.hexdigest()
+
+
+class BuildCache:
+    '''Folder of output files named after the hash of their inputs, evicted in LRU order'''
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE, verbose=False):
+        path = path or os.environ.get('PANDOCMK_CACHE') or DEFAULT_CACHE_DIR
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.verbose = verbose
+
+    def key(self, stage, args, paths, tools=()):
+        '''Key of a build stage; the versions of the -tools- that it runs (e.g. pandoc, xelatex) are part of it'''
+        from .fmt import get_engine_version
+        return hash_inputs(stage, list(args) + [get_engine_version(tool) for tool in tools], paths)
+
+    def entry(self, key, out_fn):
+        return self.path / (key + Path(out_fn).suffix)
+
+    def fetch(self, key, out_fn):
+        '''Copy the stored output to out_fn; return False if there is none'''
+        entry = self.entry(key, out_fn)
+        if not entry.is_file():
+            return False
+        shutil.copyfile(entry, out_fn)
+        os.utime(entry)  # Mark as recently used
+        if self.verbose:
+            print(f'[pandocmk] cache hit: {out_fn}')
+        return True
+
+    def store(self, key, out_fn):
+        out_fn = Path(out_fn)
+        if not out_fn.is_file():
+            return
+        # Write to a temporary name first so concurrent readers never see a partial file
+        entry = self.entry(key, out_fn)
+        tmp_fn = entry.with_name(f'{entry.name}.{os.getpid()}.tmp')
+        shutil.copyfile(out_fn, tmp_fn)
+        os.replace(tmp_fn, entry)
+        self.evict()
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits in max_size'''
+        entries = []
+        for fn in self.path.iterdir():
+            # Other processes (e.g. with -j) may evict or replace entries at the same time
+            try:
+                if fn.is_file() and fn.suffix != '.tmp':
+                    entries.append((fn.stat(), fn))
+            except OSError:
+                continue
+        total = sum(st.st_size for st, fn in entries)
+        for st, fn in sorted(entries, key=lambda x: x[0].st_mtime):
+            if total <= self.max_size:
+                break
+            fn.unlink(missing_ok=True)
+            total -= st.st_size
@@ -0,0 +1,364 @@
+"""
+Code for converting large documents to LaTeX in parallel (--chunks)
+
+The markdown is split at its level-1 headers, the sections are grouped into one chunk per CPU,
+and each chunk (with the YAML front matter of the document) is converted by its own Pandoc process. The chunks are then stitched into
+the body of a single .tex file, whose preamble is rendered separately ("frame").
+
+Pandoc adds packages to the preamble depending on the content (graphicx if there are images,
+longtable if there are tables, etc.), so chunks are rendered with a template that reports
+these variables, and the frame is rendered with the variables set by any of the chunks.
+
+Media moved to the backmatter by filters/media.py are collected from all chunks and placed
+where the #backmatter div is (see finalize_chunk() in media.py).
+
+Some Markdown constructs refer to other parts of the document, so chunks are fixed up:
+- Footnote definitions ("[^1]: ...") and link reference definitions ("[site]: https://...")
+  are copied into the other chunks that use them
+- Auto identifiers are deduplicated across chunks when they are stitched (intro, intro-1, ...),
+  as Pandoc does in a single pass
+- Implicit header references ("[Chapter 2]") to a header of another chunk can't be resolved,
+  so such documents are converted in a single pass
+
+Limitations: chunks are split only at ATX headers ("# Title") outside code blocks and divs,
+and filters that need the whole document (e.g. to number elements) see one chunk at a time.
+Definitions are found line by line, so a definition inside e.g. a list item or a block quote
+is only seen by its own chunk, and explicit identifiers repeated in several chunks are renamed.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import re
+import hashlib
+from pathlib import Path
+
+from .metadata import options2arguments
+from .deps import get_dependencies
+from .assets import has_missing_assets
+from .process import run_process
+from .trace import span
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Template variables that Pandoc sets depending on the content of the document
+FRAME_VARIABLES = ('graphics', 'tables', 'multirow', 'strikeout', 'subfigure', 'svg', 'verbatim-in-note',
+                   'csl-refs', 'dir', 'lhs', 'url', 'cancel', 'zero-width-non-joiner')
+
+BODY_PLACEHOLDER = 'PANDOCMKCHUNKBODY'
+VARIABLES_MARKER = '%% pandocmk-chunk-variables'
+HIGHLIGHTING_MARKER = '%% pandocmk-chunk-highlighting'
+
+# Written by filters/media.py when it runs on a chunk (keep in sync with finalize_chunk() there)
+FLOATS_REGEX = re.compile(r'^%% pandocmk-chunk-figures\n(.*?)^%% pandocmk-chunk-tables\n(.*?)^%% pandocmk-chunk-end\n?', re.MULTILINE | re.DOTALL)
+BACKMATTER_REGEX = re.compile(r'^%% pandocmk-chunk-backmatter\n(.*?)^%% pandocmk-chunk-div\n(.*?)^%% pandocmk-chunk-end\n?', re.MULTILINE | re.DOTALL)
+
+FENCE_REGEX = re.compile(r'^\s{0,3}(`{3,}|~{3,})')
+DIV_REGEX = re.compile(r'^\s{0,3}:{3,}\s*(\S*)')
+HEADER_REGEX = re.compile(r'^#(\s|$)')
+BACKMATTER_DIV_REGEX = re.compile(r'^\s{0,3}:{3,}\s*\{[^}]*#backmatter\b', re.MULTILINE)
+
+# Definitions that chunks may need from other chunks, and the headers that implicit references point to
+FOOTNOTE_DEF_REGEX = re.compile(r'^ {0,3}\[\^([^\]\s]+)\]:')
+LINK_DEF_REGEX = re.compile(r'^ {0,3}\[([^\]^][^\]]*)\]:(?:\s|$)')
+HEADER_TEXT_REGEX = re.compile(r'^#{1,6}\s+(.*?)(?:\s+\{[^}]*\})?\s*$')
+LABEL_REGEX = re.compile(r'\\label\{([^}]*)\}')
+DEDUP_SUFFIX_REGEX = re.compile(r'-\d+$')
+
+
+def outside_code(lines):
+    '''Yield (line, is_text) pairs, where -is_text- is False for the lines of fenced code blocks'''
+    fence = None # Opening fence of the current code block
+    for line in lines:
+        match = FENCE_REGEX.match(line)
+        if fence is not None:
+            if match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence) and not line.strip(' \t\n`~'):
+                fence = None
+            yield line, False
+        elif match:
+            fence = match.group(1)
+            yield line, False
+        else:
+            yield line, True
+
+
+def split_markdown(text):
+    '''Return the YAML front matter and the list of sections of the document, split at level-1 headers'''
+    lines = text.splitlines(keepends=True)
+
+    # YAML front matter: from a "---" first line to the next "---" or "..." line
+    front = []
+    if lines and lines[0].rstrip() == '---':
+        for i, line in enumerate(lines[1:], 1):
+            if line.rstrip() in ('---', '...'):
+                front, lines = lines[:i + 1], lines[i + 1:]
+                break
+
+    sections = [[]]
+    depth = 0 # Nesting level of fenced divs
+    for line, is_text in outside_code(lines):
+        if is_text and (match := DIV_REGEX.match(line)):
+            depth = depth + 1 if match.group(1) else max(depth - 1, 0)
+        elif is_text and depth == 0 and HEADER_REGEX.match(line) and ''.join(sections[-1]).strip():
+            sections.append([])
+        sections[-1].append(line)
+
+    return ''.join(front), [''.join(section) for section in sections]
+
+
+def group_sections(sections, num_chunks):
+    '''Join consecutive sections into at most num_chunks chunks of similar size'''
+    target = sum(len(section) for section in sections) / num_chunks
+    chunks = []
+    for section in sections:
+        if not chunks or (len(chunks[-1]) >= target and len(chunks) < num_chunks):
+            chunks.append(section)
+        else:
+            chunks[-1] += section
+    return chunks
+
+
+def find_definitions(chunk):
+    '''Return the footnote definitions, link reference definitions and header texts of a chunk'''
+    notes, links, headers = {}, {}, set()
+    block = None # Lines of the current definition
+    blank = False # Whether the current definition has a blank line so far
+    for line, is_text in outside_code(chunk.splitlines(keepends=True)):
+        if block is not None:
+            # Definitions continue with indented lines (or lazy lines of their first paragraph)
+            new_definition = is_text and (FOOTNOTE_DEF_REGEX.match(line) or LINK_DEF_REGEX.match(line))
+            if is_text and not new_definition and (not line.strip() or line.startswith(('    ', '\t')) or not blank):
+                blank = blank or not line.strip()
+                block.append(line)
+                continue
+            block = None
+        if not is_text:
+            continue
+        if (match := FOOTNOTE_DEF_REGEX.match(line)):
+            block = notes[match.group(1)] = [line]
+        elif (match := LINK_DEF_REGEX.match(line)):
+            block = links[normalize_label(match.group(1))] = [line]
+        elif (match := HEADER_TEXT_REGEX.match(line)):
+            headers.add(normalize_label(match.group(1).rstrip('# ')))
+        blank = False
+
+    join = lambda block: ''.join(block).strip('\n') + '\n'
+    return {k: join(v) for k, v in notes.items()}, {k: join(v) for k, v in links.items()}, headers
+
+
+def share_definitions(chunks):
+    '''
+    Append to each chunk the footnote and link definitions of other chunks that it uses
+
+    Return None if a chunk has an implicit reference to a header of another chunk
+    '''
+    found = [find_definitions(chunk) for chunk in chunks]
+    all_notes = {k: v for notes, _, _ in found for k, v in notes.items()}
+    all_links = {k: v for _, links, _ in found for k, v in links.items()}
+    all_headers = set().union(*(headers for _, _, headers in found))
+
+    shared = []
+    for chunk, (notes, links, headers) in zip(chunks, found):
+        text = normalize_label(chunk)
+        blocks = [block for key, block in all_notes.items() if key not in notes and f'[^{key}]' in chunk]
+        blocks += [block for key, block in all_links.items() if key not in links and f'[{key}]' in text]
+        for header in all_headers - headers - set(all_links):
+            if re.search(rf'\[{re.escape(header)}\](?![(\[:])', text):
+                return None
+        shared.append(chunk + ''.join('\n' + block for block in blocks))
+    return shared
+
+
+def normalize_label(text):
+    '''Labels of references match regardless of case and whitespace'''
+    return ' '.join(text.split()).lower()
+
+
+def run_chunked(pandoc_options, md_fn, verbose, cache=None, cancel=None, jobs=None):
+    '''
+    Build the .tex output of md_fn by converting its chunks in parallel
+
+    Return None if the document has a single chunk (so it should be converted as usual);
+    -jobs- is the number of chunks and parallel Pandoc processes (default: number of CPUs)
+    '''
+    from .core import fix_citation_options
+
+    # One chunk per worker, as each Pandoc process has a startup cost
+    jobs = jobs or os.cpu_count() or 1
+    front, sections = split_markdown(Path(md_fn).read_text(encoding='utf8'))
+    chunks = group_sections(sections, jobs)
+    if len(chunks) < 2:
+        return None
+
+    chunks = share_definitions(chunks)
+    if chunks is None:
+        if verbose:
+            print(f'[pandocmk] "{md_fn}" refers to headers across chunks; converting it in a single pass')
+        return None
+
+    if pandoc_options['output'] is None:
+        out_fn = md_fn.parent / (md_fn.stem + '.tex')
+    else:
+        out_fn = Path(pandoc_options['output'])
+        out_fn = out_fn.parent / (out_fn.stem + '.tex')
+    pandoc_options['output'] = out_fn
+    fix_citation_options(pandoc_options, 'tex')
+
+    if verbose:
+        print(f'[pandocmk] converting {len(chunks)} chunks of "{md_fn}" in parallel')
+
+    # Skip everything if the output of the whole document is in the cache
+    if cache is not None:
+        key = cache.key('pandoc-chunks', options2arguments(pandoc_options), get_dependencies(pandoc_options, md_fn), tools=['pandoc'])
+        with span('cache-fetch', ext='tex'):
+            if cache.fetch(key, out_fn) and not has_missing_assets(out_fn):
+                return out_fn
+
+    tmp_path = md_fn.parent / 'tmp'
+    tmp_path.mkdir(exist_ok=True)
+    template_fn = write_probe_template(tmp_path)
+
+    # Chunks after the one with the #backmatter div are appendices, whose media stay in place
+    backmatter = next((i for i, chunk in enumerate(chunks) if BACKMATTER_DIV_REGEX.search(chunk)), len(chunks))
+
+    def convert(i):
+        chunk_fn = tmp_path / f'{md_fn.stem}.chunk{i:04}.tex'
+        with span('chunk', index=i):
+            return convert_chunk(front + '\n' + chunks[i], pandoc_options, md_fn, chunk_fn, template_fn,
+                                 after_backmatter=i > backmatter, cache=cache, cancel=cancel)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        outputs = list(executor.map(convert, range(len(chunks))))
+
+    with span('stitch'):
+        body, variables = stitch(outputs)
+        frame = render_frame(front, pandoc_options, variables, cancel=cancel)
+        head, _, tail = frame.partition(BODY_PLACEHOLDER)
+        out_fn.write_text(head + body + tail, encoding='utf8')
+
+    if cache is not None:
+        cache.store(key, out_fn)
+
+    return out_fn
+
+
+def write_probe_template(path):
+    '''Template that outputs the body of a chunk followed by the value of FRAME_VARIABLES'''
+    lines = ['$body$', VARIABLES_MARKER]
+    lines.extend(f'$if({name})${name}$endif$' for name in FRAME_VARIABLES)
+    lines.extend([HIGHLIGHTING_MARKER, '$if(highlighting-macros)$$highlighting-macros$$endif$', ''])
+    template = '\n'.join(lines)
+
+    template_fn = path / 'pandocmk-chunk.latex'
+    if not template_fn.is_file() or template_fn.read_text(encoding='utf8') != template:
+        template_fn.write_text(template, encoding='utf8')
+    return template_fn
+
+
+def convert_chunk(text, pandoc_options, md_fn, chunk_fn, template_fn, after_backmatter, cache=None, cancel=None):
+    '''Convert one chunk (sent through stdin) and return its output'''
+    options = {k: v for k, v in pandoc_options.items() if k != 'output'}
+    options['standalone'] = True
+    options['template'] = template_fn
+
+    # Tell filters/media.py that it sees only part of the document
+    metadata = options.get('metadata', [])
+    metadata = list(metadata) if isinstance(metadata, (list, tuple)) else [metadata]
+    metadata.append('media-chunk=true')
+    if after_backmatter:
+        metadata.append('media-chunk-after-backmatter=true')
+    options['metadata'] = metadata
+    options['output'] = chunk_fn
+
+    pandoc_args = options2arguments(options)
+
+    if cache is not None:
+        # Media sources and included files of this chunk only (plus the files read by every chunk)
+        deps = get_dependencies(options, md_fn, text=text)
+        text_hash = hashlib.sha256(text.encode('utf8')).hexdigest()
+        key = cache.key('pandoc-chunk', pandoc_args + [text_hash], deps, tools=['pandoc'])
+        if cache.fetch(key, chunk_fn) and not has_missing_assets(chunk_fn):
+            return chunk_fn.read_text(encoding='utf8')
+
+    run_process(['pandoc'] + pandoc_args, input=text, cancel=cancel)
+
+    if cache is not None:
+        cache.store(key, chunk_fn)
+    return chunk_fn.read_text(encoding='utf8')
+
+
+def stitch(outputs):
+    '''Join the bodies of the chunks and the media of their backmatter; return the body and the frame variables'''
+    bodies = []
+    figures = []
+    tables = []
+    variables = {}
+    labels = set()
+    for output in outputs:
+        body, _, probe = output.partition(VARIABLES_MARKER)
+        body = rename_labels(body, labels)
+        flags, _, highlighting = probe.partition(HIGHLIGHTING_MARKER)
+        variables.update((name, True) for name in flags.split())
+        if highlighting.strip():
+            variables['highlighting-macros'] = highlighting.strip()
+
+        for match in FLOATS_REGEX.finditer(body):
+            if match.group(1).strip():
+                figures.append(match.group(1).strip())
+            if match.group(2).strip():
+                tables.append(match.group(2).strip())
+        body = FLOATS_REGEX.sub('', body).strip()
+        if body:
+            bodies.append(body)
+
+    body = '\n\n'.join(bodies)
+
+    # As in finalize() of media.py: replace the #backmatter div with the media, if there are any
+    def backmatter(match):
+        if not (figures or tables):
+            return match.group(2).strip() + '\n'
+        return '\n\n'.join([match.group(1).strip()] + figures + tables) + '\n'
+
+    body, num_backmatter = BACKMATTER_REGEX.subn(backmatter, body, count=1)
+    if (figures or tables) and not num_backmatter:
+        raise IndexError('Backmatter not found; add div with identifier "backmatter":\n::: {#backmatter}\n:::\n')
+
+    return body.strip(), variables
+
+
+def rename_labels(body, labels):
+    '''Rename the labels of a chunk that earlier chunks already used (-labels-), as Pandoc does in a single pass'''
+    originals = set()
+
+    def rename(match):
+        label = match.group(1)
+        # Pandoc already added a suffix to duplicates within the chunk ("intro-1" after "intro")
+        base = DEDUP_SUFFIX_REGEX.sub('', label)
+        base = base if base != label and base in originals else label
+        originals.add(label)
+        new, n = base, 0
+        while new in labels:
+            n += 1
+            new = f'{base}-{n}'
+        labels.add(new)
+        return rf'\label{{{new}}}'
+
+    return LABEL_REGEX.sub(rename, body)
+
+
+def render_frame(front, pandoc_options, variables, cancel=None):
+    '''Standalone output of the front matter, with a placeholder where the body goes'''
+    options = {k: v for k, v in pandoc_options.items() if k != 'output'}
+    pandoc_args = options2arguments(options)
+    for name, value in variables.items():
+        pandoc_args.append(f'--variable={name}' if value is True else f'--variable={name}={value}')
+
+    with span('frame'):
+        return run_process(['pandoc'] + pandoc_args, input=f'{front}\n{BODY_PLACEHOLDER}\n', cancel=cancel)
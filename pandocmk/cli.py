@@ -7,15 +7,15 @@ Code for interfacing with the user through the CLI
 # Imports
 # ---------------------------
 
+import os
 from pathlib import Path
 
 import click
-import backoff
 
 from .version import __version__
-from .metadata import get_pandoc_options
-from .core import build_output
-from .watch import monitor_file
+
+# Note: other pandocmk modules are imported inside main(), so "pandocmk --version" and
+# "pandocmk --help" don't have to import panflute, watchdog, etc. (see benchmarks/startup.py)
 
 
 # ---------------------------
@@ -26,81 +26,122 @@ help_str = r"""
 Pandocmk: A minimalistic make for pandoc
 ========================================
 
-Note: [FILE] must come first; and options must be --key=val or --key
+Note: options must be --key=val or --key; [FILES] can include globs such as *.md
 
 pandocmk [FILES] [OPTIONS] [PANDOC OPTIONS]
 """
 
 @click.command(help=help_str, context_settings=dict(ignore_unknown_options=True) )
 @click.version_option(version=__version__)
-@click.argument('file', type=click.Path(exists=True))
 @click.option('--view', is_flag=True, default=False, help="open output file in a viewer such as SumatraPDF for .pdf")
 @click.option('--watch', '-w', is_flag=True, default=False, help="monitor the input files for changes, and rebuild as needed")
-@click.option('--timeit', '--time', is_flag=True, default=False, help="show build time")
-@click.option('--draft', is_flag=True, default=False, help="NOT IMPLEMENTED. When building a Latex PDF, choose faster options (pdflatex, etc)")
+@click.option('--debounce', type=float, default=0.3, help="with --watch, seconds to wait for further changes before rebuilding")
+@click.option('--timeit', '--time', is_flag=True, default=False, help="show build time of each phase")
+@click.option('--trace', type=click.Path(dir_okay=False), default=None, help="save a Chrome/Perfetto trace of the build phases to this .json file")
+@click.option('--draft', is_flag=True, default=False, help="fast preview: pdflatex if possible, no bibliography, placeholder figures, one LaTeX pass")
 @click.option('--tex', is_flag=True, default=False, help="save .tex output besides .pdf")
 @click.option('--latexmk', is_flag=True, default=False, help="build pdf with latexmk; implies --tex")
+@click.option('--native', is_flag=True, default=False, help="build pdf with the built-in LaTeX driver instead of latexmk (reruns LaTeX and BibTeX only when needed); implies --latexmk")
+@click.option('--chunks', is_flag=True, default=False, help="convert large documents to LaTeX in parallel, split at level-1 headers; implies --latexmk")
+@click.option('--formats', default=None, help="comma-separated output formats built from a single parse of the markdown, such as pdf,html,docx")
+@click.option('--fmt', is_flag=True, default=False, help="with --latexmk or --draft, precompile the LaTeX preamble (requires mylatexformat)")
 @click.option('--verbose', '-v', is_flag=True, default=False, help="show debugging information")
 @click.option('--strict/--no-strict', '-s', is_flag=True, default=True, help="stop with error if style not found")
-@click.option('--retry', '-r', is_flag=True, default=False, help="try again in case of error (useful with --watch)")
-@click.argument('pandoc_args', nargs=-1, type=click.UNPROCESSED)
+@click.option('--retry', '-r', is_flag=True, default=False, help="try again in case of transient errors, such as locked files (useful with --watch)")
+@click.option('--cache/--no-cache', is_flag=True, default=True, help="reuse outputs of previous builds with identical inputs")
+@click.option('--server', is_flag=True, default=False, help="send conversions to a local pandoc server instead of starting pandoc each time")
+@click.option('--daemon', is_flag=True, default=False, help="run a build daemon; later pandocmk commands are sent to it, and start faster")
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1, help="number of files to build in parallel")
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+
+def main(view, watch, debounce, timeit, trace, draft, tex, latexmk, native, chunks, formats, fmt, verbose, strict, retry, cache, server, daemon, jobs, args):
 
-def main(file, view, watch, timeit, draft, tex, latexmk, verbose, strict, retry, pandoc_args):
+    # The chunks are stitched into a .tex file, and the native driver compiles a .tex file,
+    # so we need a LaTeX engine (not "pandoc -o file.pdf")
+    if (chunks or native) and not draft:
+        latexmk = True
 
     if latexmk:
         tex = True
 
-    if verbose:
-        print(f'[pandocmk] {verbose=} {strict=} {latexmk=} {tex=} {retry=} {timeit=}')
-
-    md_fn = Path(file)
-    assert md_fn.suffix == '.md'
-    assert md_fn.is_file()
-
-    # Get Pandoc options from CLI and YAML
-    # This also creates a temporary {filename}.yaml file with metadata based on styles
-    pandoc_options = get_pandoc_options(pandoc_args, md_fn, verbose=verbose, strict=strict)
-
-    # Optionally add watch
-    f = monitor_file if watch else build_output 
-
-    # Optionally add back-off for errors
-    # https://github.com/litl/backoff/blob/master/backoff/_wait_gen.py
-    if retry:
-        f = backoff.on_exception(wait_gen=backoff.expo, exception=Exception,
-                                 base=1, max_value=20,
-                                 max_tries=1000, max_time=600, giveup=error_is_fatal, on_backoff=print_backoff)(f)
-
-    f(md_fn, view=view, timeit=timeit, tex=tex, latexmk=latexmk, verbose=verbose, pandoc_options=pandoc_options)
+    # Formats are given by their file extension (e.g. "pdf,html,docx")
+    if formats is not None:
+        formats = [ext.strip().lstrip('.').lower() for ext in formats.split(',') if ext.strip()]
+        if not formats:
+            raise click.UsageError('--formats needs at least one format, such as pdf,html,docx')
+        if draft or chunks:
+            raise click.UsageError('--formats cannot be combined with --draft or --chunks')
 
-
-def print_backoff(args):
-    pass
-    #print(args)
-    print('BACKOFF CAUGHT AN ERROR >>>')
-
-
-def error_is_fatal(e):
-
-    print(e)
-    # BUGBUG FIXME
-    return False
-    '''If there is a deeper error (such as a not-found filter) we will abort altogether'''
-
-    # If there are no arguments (i.e. text message then we can't do anything)
-    if not e.args:
-        return False
-
-    if 'Could not find executable' in e.args[0]:
-        return True
-
-    if 'invalid api version' in e.args[0]:
-        return True
-    
-    if 'Unknown option' in e.args[0]:
-        return True
-    
-    return False
+    if verbose:
+        print(f'[pandocmk] {verbose=} {strict=} {latexmk=} {native=} {tex=} {retry=} {timeit=} {draft=} {chunks=} {formats=} {fmt=} {cache=} {server=} {jobs=}')
+
+    # Stays in the background, running the commands sent to it (see daemon.py)
+    if daemon:
+        from .daemon import serve
+        serve(server=server, verbose=verbose)
+        return
+
+    from .batch import join_option_values, split_arguments
+    from . import trace as tracer
+
+    # With --watch, folders can be given instead of files (see watchtree.py); values of Pandoc options are not inputs
+    args = join_option_values(args)
+    positional = [arg for arg in args if not arg.startswith('-')]
+    folders = [Path(arg) for arg in positional if watch and Path(arg).is_dir()]
+    files, pandoc_args = split_arguments([arg for arg in args if arg.startswith('-') or Path(arg) not in folders])
+    if not files and not folders:
+        raise click.UsageError('no input file')
+
+    # Filters don't get our options, so they read this from the environment
+    if not cache:
+        os.environ['PANDOCMK_NO_CACHE'] = '1'
+
+    # One server per session; filters and worker processes find it through an environment variable
+    if server:
+        from .server import start_server
+        start_server(verbose=verbose)
+
+    build_options = dict(pandoc_args=pandoc_args, strict=strict, retry=retry, verbose=verbose,
+                         view=view, timeit=timeit, tex=tex, latexmk=latexmk, cache=cache, draft=draft, fmt=fmt, chunks=chunks, formats=formats, native=native)
+
+    if timeit or trace:
+        tracer.enable()
+
+    try:
+        num_failed = run_builds(files, watch=watch, debounce=debounce, jobs=jobs, build_options=build_options, folders=folders)
+    finally:
+        if timeit:
+            tracer.print_summary()
+        if trace:
+            tracer.write_chrome_trace(trace)
+        if timeit or trace:
+            tracer.remove_trace_dir()
+
+    if num_failed:
+        raise SystemExit(1)
+
+
+def run_builds(files, watch, debounce, jobs, build_options, folders=()):
+    '''Build (or watch) the files; return the number of failed builds'''
+    from .batch import build_file, build_files
+
+    # Several documents (or folders of them) are watched by a single process, which builds them with -jobs- workers
+    if watch and (folders or len(files) > 1):
+        from .watchtree import watch_tree
+        watch_tree(folders, files, jobs=jobs, debounce=debounce, build_options=build_options)
+        return 0
+
+    # A single file is built in-process so errors (and tracebacks) reach the user as usual
+    if len(files) == 1:
+        # Optionally add watch
+        if watch:
+            from .watch import monitor_file
+            build_file(files[0], build=monitor_file, debounce=debounce, **build_options)
+        else:
+            build_file(files[0], **build_options)
+        return 0
+
+    return build_files(files, jobs=jobs, **build_options)
 
 
 #def inner_run_pandoc(pandoc_args):
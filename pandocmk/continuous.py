@@ -0,0 +1,93 @@
+"""
+Code for continuous (incremental) LaTeX compilation in watch mode
+
+Instead of a cold latexmk run per rebuild, we keep one "latexmk -pvc" process per document.
+It keeps its aux/toc/bbl files in ./tmp between runs, recompiles when the .tex changes,
+and only runs as many engine passes as needed.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import atexit
+import shutil
+import threading
+import subprocess
+
+from .metadata import options2arguments
+from .process import kill_process
+
+
+# ---------------------------
+# Classes
+# ---------------------------
+
+class ContinuousLatexmk:
+
+    def __init__(self, tex_fn, pdf_engine, verbose=False):
+        assert pdf_engine in ('xelatex', 'pdflatex')
+        self.tex_fn = tex_fn
+        self.pdf_engine = pdf_engine
+        self.verbose = verbose
+        self.tmp_path = tex_fn.parent / 'tmp'
+        self.proc = None
+        self.thread = None
+        self.built = threading.Event() # Set after the first build completes
+        self.stop_at_exit = False
+
+    def start(self):
+        '''Start latexmk unless it is already running'''
+        if self.proc is not None and self.proc.poll() is None:
+            return
+
+        options = {'pdf': True, 'pvc': True, 'view': 'none', 'interaction': 'nonstopmode', 'halt-on-error': True,
+                   'output-directory': str(self.tmp_path)}
+        if self.pdf_engine == 'xelatex':
+            options['pdfxe'] = True
+        cmd = ['latexmk', str(self.tex_fn)] + options2arguments(options)
+
+        if self.verbose:
+            print('[pandocmk] continuous latexmk call:')
+            print(f'    {" ".join(cmd)}')
+
+        # Delete .tex file from temp folder if it exists (else latexmk fails), as in run_latexmk()
+        self.tmp_path.mkdir(exist_ok=True)
+        (self.tmp_path / self.tex_fn.name).unlink(missing_ok=True)
+
+        # latexmk runs in its own session (so we can kill it with its engine), thus it doesn't get the
+        # Ctrl+C or SIGHUP of the terminal; we stop it ourselves, at the latest when Python exits
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     stdin=subprocess.DEVNULL, text=True, errors='replace', start_new_session=True)
+        if not self.stop_at_exit:
+            atexit.register(self.stop)
+            self.stop_at_exit = True
+        self.thread = threading.Thread(target=self.read_output, name=f'latexmk-{self.tex_fn.stem}', daemon=True)
+        self.thread.start()
+
+    def read_output(self):
+        # latexmk prints this line every time it finishes a build and goes back to waiting
+        for line in self.proc.stdout:
+            if self.verbose:
+                print(f'[latexmk] {line}', end='')
+            if line.startswith('=== Watching for updated files'):
+                self.copy_pdf()
+                self.built.set()
+
+    def copy_pdf(self):
+        '''Copy the PDF out of ./tmp (we don't move it so latexmk sees it as up to date)'''
+        pdf_fn = self.tex_fn.with_suffix('.pdf')
+        src = self.tmp_path / pdf_fn.name
+        if src.is_file() and (not pdf_fn.is_file() or src.stat().st_mtime > pdf_fn.stat().st_mtime):
+            shutil.copy2(src, pdf_fn)
+            print(f' - PDF "{pdf_fn}" updated')
+
+    def wait(self, timeout=None):
+        '''Wait until the first build completes'''
+        return self.built.wait(timeout)
+
+    def stop(self):
+        if self.proc is not None:
+            kill_process(self.proc)
+            self.proc = None
@@ -12,19 +12,29 @@ import shutil
 from pathlib import Path
 from subprocess import Popen, PIPE
 
-import panflute
-
-from .view import run_viewer
 #from .utils import get_metadata
 from .metadata import options2arguments
+from .cache import BuildCache
+from .deps import get_dependencies
+from .server import get_server_url, options2params, convert
+from .process import run_async, arun_process, gather_stages, print_output, print_stderr
+from .pipeline import READER_OPTIONS, can_share_ast, has_inprocess_filters, shared_ast, writer_options
+from .draft import run_engine_once
+from .fmt import get_format, engine_command
+from .trace import span
 
 
 # ---------------------------
 # Functions
 # ---------------------------
 
-def run_pandoc(pandoc_options, md_fn, ext, verbose):
-    assert ext in ('pdf', 'tex')
+def run_pandoc(pandoc_options, md_fn, ext, verbose, cache=None, cancel=None, ast=None):
+    return run_async(arun_pandoc(pandoc_options, md_fn, ext, verbose, cache=cache, ast=ast), cancel=cancel)
+
+
+async def arun_pandoc(pandoc_options, md_fn, ext, verbose, cache=None, ast=None):
+    # -ast- is an optional function returning the filtered AST of md_fn for an output extension (see pipeline.py)
+    # -ext- is the extension of the output (pdf, tex, html, docx, ...)
     assert isinstance(pandoc_options, dict)
 
     if pandoc_options['output'] is None:
@@ -35,15 +45,60 @@ def run_pandoc(pandoc_options, md_fn, ext, verbose):
 
     pandoc_options['output'] = out_fn
     fix_citation_options(pandoc_options, ext)
-    pandoc_args = options2arguments(pandoc_options)
-    pandoc_args.append(str(md_fn))
-    
+    fix_format_options(pandoc_options, ext)
+    if ast is None:
+        pandoc_args = options2arguments(pandoc_options)
+        pandoc_args.append(str(md_fn))
+    else:
+        pandoc_args = options2arguments(writer_options(pandoc_options)) # The AST is sent through stdin
+
     if verbose:
         print('[pandocmk] Pandoc call:')
         print(f'    pandoc {" ".join(pandoc_args)}')
         tic = time.perf_counter()
-    
-    panflute.run_pandoc(args=pandoc_args)
+
+    # Skip Pandoc if the output of a call with the same inputs is in the cache
+    if cache is not None:
+        tools = ['pandoc'] + ([pandoc_options.get('pdf-engine') or 'pdflatex'] if ext == 'pdf' else [])
+        key = cache.key('pandoc', pandoc_args, get_dependencies(pandoc_options, md_fn), tools=tools)
+        with span('cache-fetch', ext=ext):
+            cache_hit = cache.fetch(key, out_fn)
+        # A .tex is only reused if the converted figures it includes are still there (see assets.py)
+        if cache_hit and ext == 'tex':
+            from .assets import has_missing_assets
+            cache_hit = not has_missing_assets(out_fn)
+            if verbose and not cache_hit:
+                print(f'[pandocmk] converted figures of the cached {out_fn} are gone; running pandoc')
+        if cache_hit:
+            return out_fn
+
+    # The reader and filters run in a thread, so other writers (and cancellation) don't wait for them
+    import asyncio
+    source = await asyncio.to_thread(ast, ext) if ast is not None else None
+
+    # Use the pandoc server if there is one and it supports every option (else run pandoc)
+    params = None
+    if ext == 'tex' and get_server_url():
+        if ast is None:
+            params = options2params(pandoc_options, md_fn)
+        else:
+            # The reader options are already applied to the AST (the .tex gets citations through natbib)
+            options = {k: v for k, v in writer_options(pandoc_options).items() if k == 'from' or k not in READER_OPTIONS}
+            params = options2params(options, md_fn, text=source)
+    if params is not None:
+        try:
+            with span(f'pandoc server ({ext})'):
+                output = await asyncio.get_running_loop().run_in_executor(None, convert, params)
+                out_fn.write_text(output, encoding='utf8')
+        except (OSError, ValueError, KeyError) as e: # KeyError/ValueError: malformed reply
+            print(f'[pandocmk] Warning! pandoc server failed ({type(e).__name__}: {e}); running pandoc instead')
+            params = None
+    if params is None:
+        with span(f'pandoc ({ext})', args=' '.join(pandoc_args)):
+            await arun_process(['pandoc'] + pandoc_args, input=source)
+
+    if cache is not None:
+        cache.store(key, out_fn)
 
     if verbose:
         toc = time.perf_counter()
@@ -54,10 +109,9 @@ def run_pandoc(pandoc_options, md_fn, ext, verbose):
 
 def fix_citation_options(options, ext):
     # With -tex- output we need to have "citeproc" off and "natbib" on
-    # With -pdf- output we need to have "natbib" off and "citeproc" on
+    # With -pdf- output (or any other format) we need to have "natbib" off and "citeproc" on
     # In both cases the option needs to be AT THE END so it gets run after all filters
     # (because filters can include further text)
-    assert ext in ('pdf', 'tex')
     
     citation_opt = None
     for opt in ('citeproc', 'natbib'):
@@ -67,35 +121,127 @@ def fix_citation_options(options, ext):
 
     if citation_opt is not None:
         del options[citation_opt]
-        new_option = 'citeproc' if ext=='pdf' else 'natbib'
+        new_option = 'natbib' if ext=='tex' else 'citeproc'
         options[new_option] = True
 
 
-def build_output(md_fn, view, timeit, tex, latexmk,verbose, pandoc_options):
+LATEX_FORMATS = ('pdf', 'tex')
+
+# Options of styles that only apply to LaTeX output (templates and includes only if they are LaTeX files)
+LATEX_WRITER_OPTIONS = ('to', 'pdf-engine', 'pdf-engine-opt', 'listings')
+LATEX_FILE_OPTIONS = ('template', 'include-in-header', 'include-before-body', 'include-after-body')
+
+
+def fix_format_options(options, ext):
+    # Styles are written for LaTeX; for other formats (html, docx, ...) we drop the LaTeX-only options
+    # and let Pandoc choose the writer from the extension of the output
+    if ext in LATEX_FORMATS:
+        return
+
+    for opt in LATEX_WRITER_OPTIONS:
+        options.pop(opt, None)
+
+    for opt in LATEX_FILE_OPTIONS:
+        if opt in options and Path(str(options[opt])).suffix.lower() in ('.latex', '.tex'):
+            del options[opt]
+
+
+def build_formats(md_fn, formats, verbose, pandoc_options, cache=None, cancel=None, ast=None, latexmk=False, fmt=False, native=False):
+    '''
+    Write several output formats of md_fn at the same time; return a dict from each format to its output file
+
+    The writers share the parsed and filtered markdown (-ast-, see pipeline.py), so it is only read once.
+    With -latexmk-, the PDF is compiled from the .tex output once the writers are done
+    '''
+    writers = list(dict.fromkeys('tex' if ext == 'pdf' and latexmk else ext for ext in formats))
+
+    # Each writer gets a copy of the options, as arun_pandoc() changes them.
+    # If a format fails we still want the others
+    stages = [arun_pandoc(dict(pandoc_options), md_fn, ext, verbose, cache=cache, ast=ast) for ext in writers]
+    with span('formats', formats=','.join(writers)):
+        out_fns = dict(zip(writers, run_async(gather_stages(*stages, cancel_on_error=False), cancel=cancel)))
+
+    if latexmk and 'pdf' in formats:
+        pdf_engine = pandoc_options['pdf-engine']
+        assert pdf_engine in ('xelatex', 'pdflatex')
+        deps = get_dependencies(pandoc_options, md_fn) if cache is not None else None
+        out_fns['pdf'] = run_latexmk(out_fns['tex'], pdf_engine, verbose=verbose, cache=cache, deps=deps, cancel=cancel, fmt=fmt, native=native)
+
+    return {ext: out_fns[ext] for ext in formats}
+
+
+def build_output(md_fn, view, timeit, tex, latexmk,verbose, pandoc_options, cache=True, cancel=None, continuous=None, draft=False, fmt=False, chunks=False, formats=None, native=False):
 
     if verbose:
         tic = time.perf_counter()
 
-    # Build .tex output through Pandoc
-    if tex:
-        out_fn = run_pandoc(pandoc_options, md_fn, 'tex', verbose)
+    cache = BuildCache(verbose=verbose) if cache else None
+
+    # Several formats (--formats) are written from the same build; --tex adds the .tex output
+    # (drafts and chunks only produce LaTeX-based outputs, so they build the PDF as usual)
+    if formats and not (draft or chunks):
+        formats = list(dict.fromkeys(list(formats) + (['tex'] if tex else [])))
+    else:
+        formats = None
+
+    # When Pandoc writes several outputs, we parse and filter the markdown only once
+    # (lazily, so nothing is parsed if every output is in the cache).
+    # We also do so if there are panflute filters that we can run in this process
+    ast = None
+    several = formats is not None and len([ext for ext in formats if not (ext == 'pdf' and latexmk)]) > 1
+    if not chunks and can_share_ast(pandoc_options) and ((tex and not latexmk and not draft) or several or has_inprocess_filters(pandoc_options)):
+        ast = shared_ast(pandoc_options, md_fn, verbose=verbose, cancel=cancel)
+
+    # Without latexmk, the .tex and .pdf outputs are independent, so Pandoc writes both at the same time
+    # (as with --formats, see build_formats()). If the PDF fails we still want the .tex
+    concurrent = formats is not None or (tex and not (latexmk or draft or chunks))
+    if concurrent:
+        out_fns = build_formats(md_fn, formats or ['tex', 'pdf'], verbose, pandoc_options, cache=cache, cancel=cancel, ast=ast, latexmk=latexmk, fmt=fmt, native=native)
+        out_fn = out_fns.get('pdf') or next(iter(out_fns.values())) # Shown with --view
+
+    # Build .tex output through Pandoc (drafts are always compiled from the .tex)
+    elif tex or draft:
+        # Large documents can be converted in chunks, in parallel (see chunks.py)
+        out_fn = None
+        if chunks:
+            from .chunks import run_chunked
+            out_fn = run_chunked(pandoc_options, md_fn, verbose, cache=cache, cancel=cancel)
+        if out_fn is None:
+            out_fn = run_pandoc(pandoc_options, md_fn, 'tex', verbose, cache=cache, cancel=cancel, ast=ast)
         # Exit if pandoc call failed (so we don't call latexmk or pandoc again)
         if out_fn is None:
             exit()
 
     # Build .pdf output through Pandoc
-    if latexmk:
+    if concurrent:
+        pass # Already built
+    elif draft:
+        # A single LaTeX pass; see draft.py for the options set by apply_draft_options()
+        tex_fn = out_fn
+        out_fn = run_engine_once(tex_fn, pandoc_options['pdf-engine'], verbose=verbose, cancel=cancel, fmt=fmt)
+        if not tex:
+            with span('move files'):
+                shutil.move(tex_fn, tex_fn.parent / 'tmp' / tex_fn.name)
+    elif latexmk and continuous is not None:
+        # In watch mode a long-running latexmk (see continuous.py) picks up the new .tex by itself
+        continuous.start()
+        out_fn = md_fn.with_suffix('.pdf')
+        if view:
+            continuous.wait()
+    elif latexmk:
         assert tex
         # latexmk academic-markdown.tex -pdf -halt-on-error -quiet
         tex_fn = md_fn.with_suffix('.tex')
         pdf_engine = pandoc_options[ 'pdf-engine']
         assert pdf_engine in ('xelatex', 'pdflatex')  # We can add more engines, but need to customize the -latexmk- call accordingly
-        out_fn = run_latexmk(tex_fn, pdf_engine, verbose=verbose)
+        deps = get_dependencies(pandoc_options, md_fn) if cache is not None else None
+        out_fn = run_latexmk(tex_fn, pdf_engine, verbose=verbose, cache=cache, deps=deps, cancel=cancel, fmt=fmt, native=native)
     else:
-        out_fn = run_pandoc(pandoc_options, md_fn, 'pdf', verbose)
+        out_fn = run_pandoc(pandoc_options, md_fn, 'pdf', verbose, cache=cache, cancel=cancel, ast=ast)
 
     # View PDF in SumatraPDF
     if view:
+        from .view import run_viewer
         run_viewer(out_fn, verbose)
 
     if verbose:
@@ -103,17 +249,33 @@ def build_output(md_fn, view, timeit, tex, latexmk,verbose, pandoc_options):
         print(f"[pandocmk] file '{out_fn}' built in {toc - tic:0.1f} seconds")
 
 
-def run_latexmk(fn, pdf_engine, verbose):
+def run_latexmk(fn, pdf_engine, verbose, cache=None, deps=None, cancel=None, fmt=False, native=False):
+    # With -native-, we compile with our own driver instead of latexmk (see latex.py)
+    if not native and not shutil.which('latexmk'):
+        print('[pandocmk] Warning! latexmk not found; using the built-in LaTeX driver (--native)')
+        native = True
+
     options = {'pdf': True, 'halt-on-error': True, 'quiet': True, 'output-directory': './tmp'}
 
     if pdf_engine == 'xelatex':
         options['pdfxe'] = True
 
-    cmd = ['latexmk', str(fn)] + options2arguments(options)
+    # Start each LaTeX pass from the precompiled preamble (see fmt.py)
+    if fmt:
+        with span('precompile preamble'):
+            fmt = get_format(fn, pdf_engine, verbose=verbose, cancel=cancel)
+    if fmt:
+        options[pdf_engine] = ' '.join(engine_command(pdf_engine, fmt) + ['%O', '%S'])
+
+    if native:
+        cmd = engine_command(pdf_engine, fmt) # The driver adds the rest of the arguments
+    else:
+        cmd = ['latexmk', str(fn)] + options2arguments(options)
 
     if verbose:
-        print('[pandocmk] latexmk call:')
-        print(f'    {" ".join(cmd)}')
+        if not native:
+            print('[pandocmk] latexmk call:')
+            print(f'    {" ".join(cmd)}')
         tic = time.perf_counter()
 
     # We will want to keep our base folder neat so we'll move as much as possible to ./tmp
@@ -122,26 +284,58 @@ def run_latexmk(fn, pdf_engine, verbose):
     # Delete .tex file from temp folder if it exists (else latexmk fails)
     (tmp_path / fn.name).unlink(missing_ok=True)
 
-    # Run latexmk
-    try:
-        panflute.shell(cmd)
-    except IOError:
-        pass
+    # Reuse the PDF of a previous run with the same .tex and input files
+    pdf_fn = fn.with_suffix('.pdf')
+    if cache is not None:
+        tmp_path.mkdir(exist_ok=True)
+        key = cache.key('latex' if native else 'latexmk', cmd + [fn.read_text(encoding='utf8')], deps or [], tools=[pdf_engine])
+        cache_hit = cache.fetch(key, tmp_path / pdf_fn.name)
+    else:
+        cache_hit = False
+
+    # Run latexmk (or our driver)
+    error = None
+    if native and not cache_hit:
+        from .latex import run_passes
+        with span('latex', engine=pdf_engine) as stats:
+            try:
+                stats['passes'], stats['bibliography_runs'] = run_passes(fn, pdf_engine, tmp_path, verbose=verbose, cancel=cancel, fmt=fmt)
+            except IOError as e:
+                error = e
+        if cache is not None and error is None:
+            cache.store(key, tmp_path / pdf_fn.name)
+    elif not cache_hit:
+        with span('latexmk', engine=pdf_engine) as passes:
+            try:
+                # With --verbose, show the output of latexmk while it runs
+                out = run_async(arun_process(cmd, on_output=print_output if verbose else print_stderr), cancel=cancel)
+            except IOError as e:
+                out = ''
+                error = e
+            # latexmk reports each engine/bibtex run as "Run number N of rule '...'"
+            passes['passes'] = out.count('Run number')
+        # Don't cache the stale PDF left behind by a failed run
+        if cache is not None and error is None:
+            cache.store(key, tmp_path / pdf_fn.name)
 
     if verbose:
         toc = time.perf_counter()
-        print(f'[pandocmk] latexmk call completed in  {toc - tic:0.1f} seconds')
+        print(f'[pandocmk] {"LaTeX" if native else "latexmk"} call completed in  {toc - tic:0.1f} seconds')
 
-    # Copy .tex file
-    shutil.move(fn, tmp_path / fn.name)
+    # Report why LaTeX failed, not that its PDF is missing
+    if error is not None and not (tmp_path / pdf_fn.name).is_file():
+        raise error
 
-    # Copy .yaml file
-    yaml_fn = fn.with_suffix('.yaml')
-    shutil.move(yaml_fn, tmp_path / yaml_fn.name)
+    with span('move files'):
+        # Copy .tex file
+        shutil.move(fn, tmp_path / fn.name)
 
-    # Move PDF from tmp folder (use shutil.copy2 to overwrite and keep metadata)
-    pdf_fn = fn.with_suffix('.pdf')
-    src = tmp_path / pdf_fn.name
-    dst = pdf_fn.name
-    shutil.move(src, dst)
+        # Copy .yaml file
+        yaml_fn = fn.with_suffix('.yaml')
+        shutil.move(yaml_fn, tmp_path / yaml_fn.name)
+
+        # Move PDF from tmp folder (use shutil.copy2 to overwrite and keep metadata)
+        src = tmp_path / pdf_fn.name
+        dst = pdf_fn.name
+        shutil.move(src, dst)
     return pdf_fn
@@ -0,0 +1,325 @@
+"""
+Code for a long-running build daemon, and the thin client that forwards commands to it
+
+Each pandocmk command pays for Python startup and imports (click, panflute, PyYAML, ...),
+loading styles and importing filters before doing any work. "pandocmk --daemon" does that once
+and then listens on a Unix socket. The "pandocmk" command sends its arguments, folder and
+environment to the daemon, which runs the command in a fork of itself (so every command
+starts with everything loaded) and streams back its output and exit status.
+
+If there is no daemon (or PANDOCMK_NO_DAEMON is set), commands run in-process as usual.
+
+Messages are JSON lines:
+
+- client -> daemon: {"version": ..., "argv": [...], "cwd": ..., "env": {...}}
+- daemon -> client: {"out": text}, {"err": text}, and finally {"exit": code}
+  (or {"fallback": reason} if the command should run in the client instead)
+
+Notes: this module is imported by every "pandocmk" command, so it only imports the standard library
+at the top; and output written directly to file descriptors (not through sys.stdout) ends up in the daemon's terminal.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import io
+import os
+import sys
+import json
+import socket
+import threading
+from pathlib import Path
+
+from .version import __version__
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+SOCKET_ENV_VAR = 'PANDOCMK_DAEMON'
+DISABLE_ENV_VAR = 'PANDOCMK_NO_DAEMON'
+
+# Commands that run in the client: the daemon itself, and long-running interactive ones
+LOCAL_ARGUMENTS = ('--daemon', '--watch', '--help', '--version')
+LOCAL_SHORT_OPTIONS = 'w' # Also in clusters of short options, such as -vw
+VALUE_SHORT_OPTIONS = 'j' # The rest of the cluster is its value (-j4)
+
+
+def get_socket_path():
+    path = os.environ.get(SOCKET_ENV_VAR)
+    if path:
+        return Path(path)
+    root = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('PANDOCMK_CACHE') or (Path.home() / '.cache' / 'pandocmk')
+    return Path(root) / 'pandocmk-daemon.sock'
+
+
+def main():
+    '''Entry point of the "pandocmk" command: run it in the daemon if there is one, else in this process'''
+    code = forward(sys.argv[1:])
+    if code is None:
+        from .cli import main
+        return main()
+    sys.exit(code)
+
+
+def forward(argv):
+    '''Run a command in the daemon, showing its output; return its exit status, or None if it has to run here'''
+    if os.environ.get(DISABLE_ENV_VAR) or not hasattr(socket, 'AF_UNIX') or is_local(argv):
+        return None
+
+    path = get_socket_path()
+    if not path.exists():
+        return None
+
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(1)
+        conn.connect(str(path))
+        conn.settimeout(None)
+        request = {'version': __version__, 'argv': list(argv), 'cwd': os.getcwd(), 'env': dict(os.environ)}
+        conn.sendall(json.dumps(request).encode('utf8') + b'\n')
+    except OSError:
+        return None # No daemon (e.g. a socket left behind by one that was killed)
+
+    try:
+        with conn, conn.makefile('r', encoding='utf8') as reader:
+            for line in reader:
+                message = json.loads(line)
+                if 'out' in message:
+                    sys.stdout.write(message['out'])
+                    sys.stdout.flush()
+                elif 'err' in message:
+                    sys.stderr.write(message['err'])
+                    sys.stderr.flush()
+                elif 'exit' in message:
+                    return message['exit']
+                elif 'fallback' in message:
+                    return None
+    except KeyboardInterrupt:
+        return 130
+    except OSError:
+        pass
+    print('[pandocmk] Error! lost connection with the daemon', file=sys.stderr)
+    return 1
+
+
+def is_local(argv):
+    '''Check if a command has to run in the client; short options are read as click does'''
+    for arg in argv:
+        if arg in LOCAL_ARGUMENTS:
+            return True
+        if arg.startswith('-') and not arg.startswith('--'):
+            flags = arg[1:]
+            for option in VALUE_SHORT_OPTIONS:
+                flags = flags.split(option, 1)[0]
+            if any(flag in flags for flag in LOCAL_SHORT_OPTIONS):
+                return True
+    return False
+
+
+def serve(path=None, server=False, verbose=False):
+    '''Run the daemon until interrupted (Ctrl+C)'''
+    if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit('[pandocmk] Error! --daemon requires Unix sockets and os.fork()')
+
+    path = Path(path or get_socket_path())
+    if forward_is_possible(path):
+        raise SystemExit(f'[pandocmk] Error! a daemon is already listening on "{path}"')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+
+    # Commands forked from us find all of this loaded
+    preload(Path.cwd() / 'daemon.md', verbose=verbose)
+    if server:
+        from .server import start_server
+        start_server(verbose=verbose)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077) # Only our user can connect
+    try:
+        listener.bind(str(path))
+    finally:
+        os.umask(umask)
+    listener.listen()
+
+    # "kill" (e.g. from a service manager) stops us as Ctrl+C does, so the socket is removed
+    import signal
+    signal.signal(signal.SIGTERM, stop_daemon)
+
+    print(f'[pandocmk] daemon listening on "{path}" (pid {os.getpid()})', flush=True)
+    import select
+    pending = {} # Documents to preload when there are no commands waiting
+    try:
+        while True:
+            reap_children()
+            # Wake up every second to reap finished commands; don't wait if there is something to preload
+            ready, _, _ = select.select([listener], [], [], 0 if pending else 1)
+            if ready:
+                conn, _ = listener.accept()
+                pending.update(dict.fromkeys(handle(conn, listener, verbose=verbose)))
+            elif pending:
+                md_fn = next(iter(pending))
+                del pending[md_fn]
+                try:
+                    preload(md_fn)
+                except Exception:
+                    pass # Errors are reported by the build itself
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        path.unlink(missing_ok=True)
+    print('[pandocmk] daemon stopped')
+
+
+def forward_is_possible(path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(1)
+            conn.connect(str(path))
+        return True
+    except OSError:
+        return False
+
+
+def preload(md_fn, verbose=False):
+    '''Import the modules used by builds, and load the styles (and their in-process filters) of a document'''
+    from . import cli, batch, core
+    from .registry import load_styles
+    from .pipeline import load_filter, get_pandoc_version
+
+    for settings in load_styles(md_fn, verbose=verbose).values():
+        filters = (settings.get('pandoc') or {}).get('filter') or []
+        for fn in filters if isinstance(filters, list) else [filters]:
+            try:
+                load_filter(fn)
+            except Exception as e:
+                print(f'[pandocmk] Warning! could not preload filter "{fn}": {e}')
+
+    try:
+        get_pandoc_version()
+    except OSError:
+        pass
+
+
+def stop_daemon(signum, frame):
+    raise KeyboardInterrupt
+
+
+def reap_children():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def handle(conn, listener, verbose=False):
+    '''Run a command in a fork; return the documents it builds (to preload them for the next commands)'''
+    with conn:
+        try:
+            line = conn.makefile('r', encoding='utf8').readline()
+            request = json.loads(line)
+        except (OSError, ValueError):
+            return []
+
+        if request.get('version') != __version__:
+            send(conn, {'fallback': f'the daemon runs pandocmk {__version__}'})
+            return []
+
+        if verbose:
+            print(f'[pandocmk] running "pandocmk {" ".join(request["argv"])}" in "{request["cwd"]}"')
+
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            code = 1
+            try:
+                code = run_command(conn, request)
+            finally:
+                os._exit(code) # Skip the cleanup of the daemon (atexit functions, etc.)
+
+    # Get ready for the next commands of these documents (once no command is waiting, see serve())
+    return [Path(request['cwd']) / arg for arg in request['argv'] if arg.endswith('.md') and not arg.startswith('-')]
+
+
+def run_command(conn, request):
+    '''Run a forwarded command (in a forked process) with its output sent to the client; return its exit status'''
+    import signal
+    import traceback
+    from .cli import main
+    from .server import SERVER_ENV_VAR, stop_server
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Run as the client would: from its folder, with its environment (plus the pandoc server of the daemon)
+    server_url = os.environ.get(SERVER_ENV_VAR)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    if server_url and not os.environ.get(SERVER_ENV_VAR):
+        os.environ[SERVER_ENV_VAR] = server_url
+
+    lock = threading.Lock()
+    sys.stdout = SocketWriter(conn, 'out', lock)
+    sys.stderr = SocketWriter(conn, 'err', lock)
+
+    try:
+        main.main(args=request['argv'], prog_name='pandocmk', standalone_mode=True)
+        code = 0
+    except SystemExit as e:
+        # As Python does: print messages, and exit with status 1
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        if os.environ.get(SERVER_ENV_VAR) != server_url:
+            stop_server() # Started by this command (with --server)
+
+    with lock:
+        send(conn, {'exit': code})
+    return code
+
+
+def send(conn, message):
+    try:
+        conn.sendall(json.dumps(message).encode('utf8') + b'\n')
+    except OSError:
+        pass # The client is gone (e.g. Ctrl+C); the build still finishes, so its outputs get cached
+
+
+# ---------------------------
+# Classes
+# ---------------------------
+
+class SocketWriter(io.TextIOBase):
+    '''Stand-in for sys.stdout/sys.stderr that sends what is written to the client'''
+
+    def __init__(self, conn, stream, lock):
+        self.conn = conn
+        self.stream = stream
+        self.lock = lock
+
+    def write(self, text):
+        if text:
+            with self.lock:
+                send(self.conn, {self.stream: text})
+        return len(text)
+
+    def isatty(self):
+        return False
+
+    @property
+    def encoding(self):
+        return 'utf-8'
@@ -0,0 +1,160 @@
+"""
+Code for finding the files that a build depends on
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import re
+from pathlib import Path
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Options whose values are paths to files read by Pandoc
+PATH_OPTIONS = ('template', 'filter', 'lua-filter', 'metadata-file', 'bibliography', 'csl',
+                'include-in-header', 'include-before-body', 'include-after-body', 'reference-doc')
+
+# Matches the "source: ..." lines of the table/figure/figures/stlog blocks used by filters/media.py
+SOURCE_REGEX = re.compile(r'^\s*-?\s*source\s*:\s*(.+?)\s*$', re.MULTILINE)
+
+# Matches the "!include file" lines of the pandoc-include filter
+INCLUDE_REGEX = re.compile(r'^!include(?:-header)?\s+(?:`(.+?)`|(.+?))\s*$', re.MULTILINE)
+
+# Images: Markdown "![caption](file)", "![caption][label]" (with "[label]: file"), and HTML "<img src=...>"
+IMAGE_REGEX = re.compile(r'!\[((?:[^\[\]]|\[[^\]]*\])*)\]\(\s*(?:<([^>]+)>|([^)\s]+))')
+IMAGE_LABEL_REGEX = re.compile(r'!\[((?:[^\[\]]|\[[^\]]*\])*)\](?!\()(?:\[([^\]]*)\])?')
+LINK_DEF_REGEX = re.compile(r'^ {0,3}\[([^\]^][^\]]*)\]:\s*(?:<([^>]+)>|(\S+))', re.MULTILINE)
+HTML_IMAGE_REGEX = re.compile(r'<img\b[^>]*?\bsrc\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+URL_REGEX = re.compile(r'^(?:[a-zA-Z][\w+.-]*:|#)') # URLs, and links within the document
+
+# Raw LaTeX (in the markdown or in files it inputs): "\input{file}", "\include{file}", "\includegraphics{file.png}"
+LATEX_INPUT_REGEX = re.compile(r'\\(input|include|includegraphics)\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}')
+
+# Partials of Pandoc templates: "$name()$", "${ name() }", "${ var:name() }"
+PARTIAL_REGEX = re.compile(r'\$\{?\s*(?:[\w.-]+:)?([\w./-]+)\(\)')
+
+
+def get_dependencies(pandoc_options, md_fn, text=None):
+    '''
+    List of files read when building md_fn with the given options (missing files included)
+
+    If -text- is given, it is used instead of the content of md_fn (e.g. a chunk of it, see chunks.py)
+    '''
+    deps = [Path(md_fn)] if text is None else []
+
+    for k in PATH_OPTIONS:
+        v = pandoc_options.get(k)
+        if not v:
+            continue
+        values = v if isinstance(v, (list, tuple)) else [v]
+        for fn in values:
+            fn = Path(str(fn))
+            # Bibliography paths are stored without the .bib extension (see get_pandoc_options)
+            if k == 'bibliography' and not fn.suffix:
+                fn = fn.with_suffix('.bib')
+            deps.append(fn)
+            if k == 'template':
+                deps.extend(get_template_partials(fn))
+
+    # Images are looked up in each folder of --resource-path (by default, the current folder)
+    resource_paths = get_resource_paths(pandoc_options)
+
+    # Files added by pandoc-include can have their own media blocks and includes,
+    # and LaTeX files can input other files
+    pending = [(Path(md_fn), text)]
+    visited = set()
+    while pending:
+        fn, fn_text = pending.pop()
+        if fn in visited or (fn_text is None and not fn.is_file()):
+            continue
+        visited.add(fn)
+        if fn_text is None:
+            fn_text = fn.read_text(encoding='utf8', errors='replace')
+        inputs = get_latex_inputs(fn_text)
+        includes = [] if fn.suffix.lower() == '.tex' else get_include_files(fn_text)
+        if fn.suffix.lower() != '.tex':
+            deps.extend(get_media_sources(fn_text))
+            deps.extend(image for fn in get_images(fn_text) for image in find_resource(fn, resource_paths))
+        deps.extend(includes + inputs)
+        pending.extend((include, None) for include in includes + [fn for fn in inputs if fn.suffix.lower() == '.tex'])
+
+    # Remove duplicates but keep order
+    return list(dict.fromkeys(deps))
+
+
+def get_media_sources(text):
+    '''Source files of media blocks, relative to the current folder as in filters/media.py'''
+    return [Path(fn.strip('\'"')) for fn in SOURCE_REGEX.findall(text)]
+
+
+def get_include_files(text):
+    '''Files included through pandoc-include (paths are relative to the current folder)'''
+    return [Path(a or b) for a, b in INCLUDE_REGEX.findall(text)]
+
+
+def get_images(text):
+    '''Local images of Markdown and HTML image elements (paths are relative to the current folder)'''
+    targets = [a or b for _, a, b in IMAGE_REGEX.findall(text)]
+    targets += HTML_IMAGE_REGEX.findall(text)
+
+    # Reference-style images use the target of a link definition
+    definitions = {normalize_label(label): a or b for label, a, b in LINK_DEF_REGEX.findall(text)}
+    for caption, label in IMAGE_LABEL_REGEX.findall(text):
+        if (target := definitions.get(normalize_label(label or caption))):
+            targets.append(target)
+
+    return [Path(target) for target in targets if not URL_REGEX.match(target)]
+
+
+def get_resource_paths(pandoc_options):
+    '''Folders of the resource-path option of Pandoc (a list, or a string separated by os.pathsep as in the CLI)'''
+    value = pandoc_options.get('resource-path') or ['.']
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [Path(folder) for v in values for folder in str(v).split(os.pathsep) if folder]
+
+
+def find_resource(fn, resource_paths):
+    '''Candidate paths of a resource; all of them are inputs, as adding a file to an earlier folder changes the result'''
+    return [fn] if fn.is_absolute() else [folder / fn for folder in resource_paths]
+
+
+def get_latex_inputs(text):
+    '''Files read by raw LaTeX; \\input and \\include add .tex to names without extension, as LaTeX does'''
+    files = []
+    for command, fn in LATEX_INPUT_REGEX.findall(text):
+        fn = Path(fn.strip(' \'"'))
+        if not fn.suffix and command != 'includegraphics':
+            fn = fn.with_suffix('.tex')
+        # Graphics without extension can be any of several files, which LaTeX picks
+        if fn.suffix:
+            files.append(fn)
+    return files
+
+
+def get_template_partials(template_fn):
+    '''Partials used by a template (recursively); they are next to it, with its extension if they have none'''
+    partials = []
+    pending = [Path(template_fn)]
+    while pending:
+        fn = pending.pop()
+        if not fn.is_file():
+            continue
+        for name in PARTIAL_REGEX.findall(fn.read_text(encoding='utf8', errors='replace')):
+            partial = fn.parent / name
+            if not partial.suffix:
+                partial = partial.with_suffix(Path(template_fn).suffix)
+            if partial not in partials:
+                partials.append(partial)
+                pending.append(partial)
+    return partials
+
+
+def normalize_label(label):
+    '''Link labels match regardless of case and whitespace'''
+    return ' '.join(label.split()).lower()
@@ -0,0 +1,88 @@
+"""
+Code for --draft builds: faster but less accurate PDFs for authors iterating on text
+
+- Use pdflatex unless the style needs xelatex (e.g. it sets system fonts)
+- Skip bibliography processing (citations are shown as keys)
+- Replace figures emitted by filters/media.py with placeholder boxes
+- Run a single LaTeX pass, reusing the .aux of the previous draft for references
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import shutil
+from pathlib import Path
+
+import yaml
+
+from .metadata import get_yaml_metadata
+from .process import run_process
+from .fmt import get_format, engine_command
+from .trace import span
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Metadata that requires fontspec, and thus xelatex or lualatex
+FONTSPEC_KEYS = ('mainfont', 'sansfont', 'monofont', 'mathfont', 'CJKmainfont')
+
+CITATION_OPTIONS = ('bibliography', 'citeproc', 'natbib', 'biblatex', 'csl')
+
+
+def apply_draft_options(options, md_fn, verbose=False):
+    '''Modify Pandoc options in place for a draft build'''
+
+    if not needs_fontspec(options, md_fn):
+        options['pdf-engine'] = 'pdflatex'
+
+    for key in CITATION_OPTIONS:
+        options.pop(key, None)
+
+    # Tell filters/media.py to use placeholders instead of images
+    metadata = options.get('metadata', [])
+    metadata = metadata if isinstance(metadata, list) else [metadata]
+    options['metadata'] = metadata + ['media-draft']
+
+    if verbose:
+        print(f'[pandocmk] draft mode: pdf-engine={options["pdf-engine"]}, no bibliography, placeholder figures')
+
+    return options
+
+
+def needs_fontspec(options, md_fn):
+    metadata_files = options.get('metadata-file', [])
+    metadata_files = metadata_files if isinstance(metadata_files, list) else [metadata_files]
+
+    metadata = [get_yaml_metadata(md_fn)]
+    for fn in metadata_files:
+        fn = Path(fn)
+        if fn.is_file():
+            metadata.append(yaml.safe_load(fn.read_text(encoding='utf8')) or {})
+
+    return any(key in meta for meta in metadata for key in FONTSPEC_KEYS)
+
+
+def run_engine_once(tex_fn, pdf_engine, verbose=False, cancel=None, fmt=False):
+    '''Compile a .tex file with a single LaTeX pass, keeping auxiliary files in ./tmp'''
+    tmp_path = tex_fn.parent / 'tmp'
+    tmp_path.mkdir(exist_ok=True)
+    if fmt:
+        with span('precompile preamble'):
+            fmt = get_format(tex_fn, pdf_engine, verbose=verbose, cancel=cancel)
+    cmd = engine_command(pdf_engine, fmt) + ['-interaction=nonstopmode', '-halt-on-error', f'-output-directory={tmp_path}', str(tex_fn)]
+
+    if verbose:
+        print('[pandocmk] LaTeX call:')
+        print(f'    {" ".join(cmd)}')
+
+    with span('latex pass', engine=pdf_engine):
+        run_process(cmd, cancel=cancel)
+
+    pdf_fn = tex_fn.with_suffix('.pdf')
+    with span('move files'):
+        shutil.move(tmp_path / pdf_fn.name, pdf_fn)
+    return pdf_fn
@@ -0,0 +1,168 @@
+"""
+Code for classifying build errors, so --retry only retries the ones that can go away on their own
+
+- Transient: locked files (e.g. a PDF open in a viewer), a source that changed or vanished while
+  it was read (e.g. an editor saving it), a figure that is still being written, timeouts
+  (a missing file is only transient if it is the document itself, or if it was written during the build)
+- Deterministic: missing executables or filters, unknown options, YAML and LaTeX errors, bugs,
+  permissions (an unreadable file or a read-only folder doesn't fix itself)
+
+LaTeX errors are read from the log left in ./tmp by latexmk and --draft, or else from the
+error message of Pandoc (which includes the relevant lines of the log when it runs the engine).
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import re
+from pathlib import Path
+from collections import namedtuple
+
+from .process import BuildCancelled
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+BuildError = namedtuple('BuildError', ['transient', 'message'])
+
+# Error messages of Pandoc, filters and the OS; the first match wins (so transient patterns go first).
+# Missing files (None) are transient only if they were written during the build, see is_recreated()
+MESSAGE_PATTERNS = [
+    (True, re.compile(r'being used by another process|Resource temporarily unavailable|'
+                      r'Device or resource busy|Text file busy'), 'file is locked'),
+    (True, re.compile(r'did not finish in \d+ seconds'), 'timed out'),
+    (None, re.compile(r'(\S+): (?:withBinaryFile|openFile|openBinaryFile): does not exist'), 'file "{0}" not found'),
+    (False, re.compile(r'Could not find executable "?([^"\n]+)"?'), 'executable "{0}" not found'),
+    (False, re.compile(r'(\S+) not found\. Please select a different --pdf-engine'), 'PDF engine "{0}" not found'),
+    (False, re.compile(r'(?:Unknown|unrecognized) option:? ?(-*[\w-]*)'), 'unknown Pandoc option {0}'),
+    (False, re.compile(r'Unknown (?:input|output) format:? ?(\S*)'), 'unknown Pandoc format {0}'),
+    (False, re.compile(r'invalid api version'), 'filter requires a different version of Pandoc (invalid api version)'),
+    (False, re.compile(r'Could not find (?:data file|template)s? ?(\S*)'), 'template or data file {0} not found'),
+    (False, re.compile(r'YAML parse exception at line (\d+)'), 'invalid YAML metadata (line {0})'),
+    (False, re.compile(r'Error parsing YAML metadata'), 'invalid YAML metadata'),
+]
+
+FILTER_ERROR_REGEX = re.compile(r'Error running filter ([^\s:]+)')
+TRANSIENT_EXCEPTIONS = (TimeoutError, BlockingIOError, InterruptedError)
+MISSING_FILE_REGEX = re.compile(r'^FileNotFoundError: .*?: \'([^\']+)\'')
+
+# LaTeX errors: "! message" followed (a few lines below) by "l.123 context"
+LATEX_ERROR_REGEX = re.compile(r'^! (.+)$', re.MULTILINE)
+LATEX_LINE_REGEX = re.compile(r'^l\.(\d+) ?(.*)$', re.MULTILINE)
+LATEX_MISSING_REGEX = re.compile(r"File `([^']+)' not found|I can't find file `([^']+)'")
+LATEX_LOCKED_REGEX = re.compile(r"I can't write on file `([^']+)'")
+LATEX_PACKAGE_SUFFIXES = ('.sty', '.cls', '.clo', '.def', '.fd', '.cfg', '.ldf', '.bst', '.tfm')
+LATEX_GRAPHICS_SUFFIXES = ('.pdf', '.png', '.jpg', '.jpeg', '.eps', '.tex')
+
+
+def classify_error(e, md_fn=None, since=None):
+    '''
+    Return a BuildError(transient, message) describing why a build failed
+
+    -since- is the time (as in time.time()) the failed build started; with it, the source file
+    and the LaTeX log of -md_fn- are checked for changes made during the build
+    '''
+    if isinstance(e, BuildCancelled):
+        return BuildError(False, 'build cancelled')
+
+    if isinstance(e, SystemExit):
+        return BuildError(False, re.sub(r'^\[pandocmk\] Error! ', '', str(e)))
+
+    # A source saved (or deleted and recreated) by an editor while it was being read
+    if md_fn is not None and since is not None:
+        try:
+            if Path(md_fn).stat().st_mtime >= since:
+                return BuildError(True, f'"{md_fn}" changed during the build')
+        except FileNotFoundError:
+            return BuildError(True, f'"{md_fn}" not found (is it being saved?)')
+
+    text = str(e)
+
+    # LaTeX errors come first, as they also cause the failures of the steps that follow
+    log = read_latex_log(md_fn, since)
+    error = classify_latex_error(log) or classify_latex_error(text)
+    if error is not None:
+        return error
+
+    for transient, regex, message in MESSAGE_PATTERNS:
+        if (match := regex.search(text)):
+            if transient is None:
+                transient = is_recreated(match.group(1), since)
+            return BuildError(transient, message.format(*match.groups()).strip())
+
+    # Tracebacks of filters end with the exception that stopped them
+    if (match := FILTER_ERROR_REGEX.search(text)):
+        lines = [line.strip() for line in text[:match.start()].splitlines() if line.strip()]
+        last = lines[-1] if lines else ''
+        transient = last.startswith(tuple(exc.__name__ for exc in TRANSIENT_EXCEPTIONS))
+        if (missing := MISSING_FILE_REGEX.match(last)):
+            transient = is_recreated(missing.group(1), since)
+        return BuildError(transient, f'filter {match.group(1)} failed' + (f': {last}' if last else ''))
+
+    first_line = next((line.strip() for line in text.splitlines() if line.strip()), '')
+    message = f'{type(e).__name__}: {first_line}' if first_line else type(e).__name__
+    transient = isinstance(e, TRANSIENT_EXCEPTIONS) or (isinstance(e, FileNotFoundError) and is_recreated(e.filename, since))
+    return BuildError(transient, message)
+
+
+def is_recreated(fn, since=None):
+    '''Return True if the file -fn- exists and was written after -since- (e.g. a figure that Stata was still writing)'''
+    if not fn or since is None:
+        return False
+    try:
+        return Path(fn).stat().st_mtime >= since
+    except OSError:
+        return False
+
+
+def read_latex_log(md_fn, since=None):
+    '''Return the LaTeX log of the document if it was written after -since- (else an empty string)'''
+    if md_fn is None or since is None:
+        return ''
+    md_fn = Path(md_fn)
+    for log_fn in (md_fn.parent / 'tmp' / (md_fn.stem + '.log'), md_fn.with_suffix('.log')):
+        try:
+            if log_fn.stat().st_mtime >= since:
+                return log_fn.read_text(encoding='utf8', errors='replace')
+        except FileNotFoundError:
+            pass
+    return ''
+
+
+def parse_latex_errors(text):
+    '''Return the (message, line number, context) of each LaTeX error in a log'''
+    errors = []
+    for match in LATEX_ERROR_REGEX.finditer(text):
+        # The "l.N" line is a few lines below the message (after help text such as "Type X to quit")
+        line = LATEX_LINE_REGEX.search(text, match.end(), match.end() + 2000)
+        if line and not LATEX_ERROR_REGEX.search(text, match.end(), line.start()):
+            errors.append((match.group(1).strip(), int(line.group(1)), line.group(2).strip()))
+        else:
+            errors.append((match.group(1).strip(), None, ''))
+    return errors
+
+
+def classify_latex_error(text):
+    '''Classify the first LaTeX error in a log (the others usually follow from it); return None if there is none'''
+    errors = [error for error in parse_latex_errors(text) if error[0] not in ('Emergency stop.', '==> Fatal error occurred, no output PDF file produced!')]
+    if not errors:
+        return None
+    message, line, context = errors[0]
+    where = f' (line {line} of the .tex: {context})' if line is not None else ''
+
+    if (match := LATEX_LOCKED_REGEX.search(message)):
+        return BuildError(True, f'LaTeX cannot write "{match.group(1)}" (is it open in another program?)')
+
+    if (match := LATEX_MISSING_REGEX.search(message)):
+        fn = match.group(1) or match.group(2)
+        if Path(fn).suffix.lower() in LATEX_PACKAGE_SUFFIXES:
+            return BuildError(False, f'LaTeX file "{fn}" not found (is the package installed?)')
+        # A figure or table that exists by now was still being written (e.g. by Stata)
+        exists = any(Path(fn + suffix).is_file() for suffix in ('',) + LATEX_GRAPHICS_SUFFIXES)
+        return BuildError(exists, f'LaTeX file "{fn}" not found{where}')
+
+    return BuildError(False, f'LaTeX error: {message}{where}')
@@ -11,21 +11,63 @@ and used to input and build the corresponding .tex lines.
 # Imports
 # ---------------------------
 
+import os
 import re
+import json
+import hashlib
 from pathlib import Path
 #from functools import partial
 
+import yaml
 import panflute as pf
 
+# When run inside pandocmk, record the time spent in conversions (see pandocmk --timeit)
+try:
+    from pandocmk.trace import span
+except ImportError:
+    from contextlib import nullcontext
+    def span(name, **args):
+        return nullcontext()
+
+# Image preprocessing (SVG to PDF, downsampling) and TikZ externalization are only available with pandocmk
+try:
+    from pandocmk.assets import prepare_media
+except ImportError:
+    prepare_media = None
+
+# Conversions can go to the pandoc server started by "pandocmk --server" (see pandocmk/server.py)
+try:
+    from pandocmk.server import convert as convert_with_server
+except ImportError:
+    convert_with_server = None
+
 
 # ---------------------------
 # Main filter functions
 # ---------------------------
 
+MEDIA_TAGS = ('table', 'figure', 'figures', 'stlog')
+MEMO_MAX_ENTRIES = 5000
+LATEX_OUTPUTS = ('latex', 'beamer')
+
+
 def prepare(doc):
     doc.tables = []
     doc.figures = []
 
+    # Other formats (html, docx, ...) get Pandoc elements instead of LaTeX snippets (see "Snippets for other formats")
+    doc.is_latex = doc.format in LATEX_OUTPUTS
+
+    # Folder with the snippets rendered by previous runs (only LaTeX snippets are saved)
+    doc.memo_path = get_memo_path(doc) if doc.is_latex else None
+
+    # Convert SVGs to PDF, downsample large images and compile TikZ figures to PDF
+    # (only with "media-tikz-external: true"), in a single process pool (see pandocmk/assets.py)
+    doc.assets, doc.tikz = prepare_media_files(collect_images(doc), collect_tikz(doc), doc)
+
+    # Convert all titles, subtitles and notes with a single Pandoc call
+    doc.adornments = (convert_batch if doc.is_latex else convert_batch_inlines)(collect_adornments(doc), doc)
+
     # Find position of backmatter so we don't move anything after it
     doc.backmatter_index = find_backmatter(doc)
 
@@ -45,7 +87,9 @@ def prepare(doc):
 
 def finalize(doc):
     has_backmatter = doc.tables or doc.figures
-    if has_backmatter:
+    if doc.get_metadata('media-chunk', False):
+        finalize_chunk(doc)
+    elif has_backmatter:
         pos = doc.backmatter_index   # Already searched by prepare()
         if pos is None:
             raise IndexError('Backmatter not found; add div with identifier "backmatter":\n::: {#backmatter}\n:::\n')
@@ -55,10 +99,56 @@ def finalize(doc):
         for table in doc.tables:
             backmatter.append(table)
         doc.content[pos] = pf.Div(*backmatter)
-    pass
+
+    if doc.memo_path is not None:
+        memo_evict(doc.memo_path)
+
+
+def finalize_chunk(doc):
+    '''
+    With "pandocmk --chunks" we only see part of the document, and other chunks might have
+    media for the backmatter, so we mark where the backmatter div and our media are
+    and pandocmk stitches them together (see pandocmk/chunks.py)
+    '''
+    marker = lambda name: pf.RawBlock(f'%% pandocmk-chunk-{name}', format='latex')
+
+    pos = doc.backmatter_index
+    if pos is not None:
+        # Keep both versions of the div, as we don't know if there will be any media
+        heading = [pf.RawBlock(r'\clearpage', format='latex'), pf.Header(pf.Str('Figures and Tables'), level=1, identifier='backmatter', classes=['unnumbered'])]
+        doc.content[pos] = pf.Div(marker('backmatter'), *heading, marker('div'), doc.content[pos], marker('end'))
+
+    doc.content.extend([marker('figures'), *doc.figures, marker('tables'), *doc.tables, marker('end')])
 
 
 def table_fenced_action(options, data, element, doc):
+    snippet = render_media('table', options, doc)
+    label = get_label(options, default_title='Untitled Table')
+    return place_media(snippet, label, element, doc, doc.tables)
+
+
+def figure_fenced_action(options, data, element, doc):
+    snippet = render_media('figure', options, doc)
+    label = get_label(options, default_title='Untitled Figure')
+    return place_media(snippet, label, element, doc, doc.figures)
+
+
+def figures_fenced_action(options, data, element, doc):
+    snippet = render_media('figures', options, doc)
+    label = get_label(options, default_title='Untitled Figure')
+    return place_media(snippet, label, element, doc, doc.figures)
+
+
+def stlog_fenced_action(options, data, element, doc):
+    # Stata logs are never moved to the back
+    return render_media('stlog', options, doc)
+
+
+# ---------------------------
+# Snippet functions
+# ---------------------------
+
+def table_snippet(options, doc):
 
     is_beamer = doc.get_metadata('pandoc.to') == 'beamer'
 
@@ -69,7 +159,6 @@ def table_fenced_action(options, data, element, doc):
     size = options.get('size', 5)
 
     pagebreak = doc.get_metadata('media-pagebreak', False) # Force pagebreak after media
-    media_in_back = decide_media_on_back(element, doc)
 
     #title_suffix = ' --- ' if subtitle else ''
     title_suffix = '. ' if subtitle else ''
@@ -96,15 +185,10 @@ def table_fenced_action(options, data, element, doc):
     file_found = Path(source).is_file()
     snippet = latexblock(snippet, file_found)
 
-    if media_in_back:
-        doc.tables.append(snippet)
-        msg = rf'\begin{{center}}\hyperref[{label}]{{[\Cref{{{label}}} about here]}}\end{{center}}'
-        return pf.RawBlock(msg, format='latex')
-    else:
-        return snippet
+    return snippet
 
 
-def figure_fenced_action(options, data, element, doc):
+def figure_snippet(options, doc):
 
     is_beamer = doc.get_metadata('pandoc.to') == 'beamer'
 
@@ -114,9 +198,9 @@ def figure_fenced_action(options, data, element, doc):
     is_landscape = options.get('orientation', 'portrait') == 'landscape'
     is_tikz = options.get('tikz', False)
     width = options.get('size', 1)
+    is_draft = doc.get_metadata('media-draft', False) # Placeholders instead of images (pandocmk --draft)
 
     pagebreak = doc.get_metadata('media-pagebreak', False) # Force pagebreak after media
-    media_in_back = decide_media_on_back(element, doc)
 
     #title_suffix = ' --- ' if subtitle else ''
     title_suffix = '. ' if subtitle else ''
@@ -130,10 +214,16 @@ def figure_fenced_action(options, data, element, doc):
     snippet.append(r'  \begin{figure}[htpb]')
     snippet.append(r'    \centering')
 
-    if is_tikz:
+    if is_tikz and is_draft:
+        snippet.append(rf'    \fbox{{\parbox{{{width}\textwidth}}{{\centering\vspace{{4em}}\texttt{{\detokenize{{{source}}}}}\vspace{{4em}}}}}}')
+    elif is_tikz and doc.tikz.get(source):
+        snippet.append(rf'    \includegraphics{{"{doc.tikz[source]}"}}')
+    elif is_tikz:
         snippet.append(rf'    \input{{"{source}"}}')
     else:
-        snippet.append(rf'    \includegraphics[width={width}\textwidth]{{"{source}"}}')
+        draft_option = 'draft,' if is_draft else ''
+        image = doc.assets.get((source, width), source)
+        snippet.append(rf'    \includegraphics[{draft_option}width={width}\textwidth]{{"{image}"}}')
     
     if title or subtitle:
         snippet.append(rf'    \caption{{\textbf{{{title}{title_suffix}}}{subtitle}}}')
@@ -146,15 +236,10 @@ def figure_fenced_action(options, data, element, doc):
     file_found = Path(source).is_file()
     snippet = latexblock(snippet, file_found)
 
-    if media_in_back:
-        doc.figures.append(snippet)
-        msg = rf'\begin{{center}}\hyperref[{label}]{{[\Cref{{{label}}} about here]}}\end{{center}}'
-        return pf.RawBlock(msg, format='latex')
-    else:
-        return snippet
+    return snippet
 
 
-def figures_fenced_action(options, data, element, doc):
+def figures_snippet(options, doc):
     '''Figure with multiple subfigures in panels'''
 
     is_beamer = doc.get_metadata('pandoc.to') == 'beamer'
@@ -165,8 +250,8 @@ def figures_fenced_action(options, data, element, doc):
     placement = options.get('placement', 'htpb')
 
     pagebreak = doc.get_metadata('media-pagebreak', False) # Force pagebreak after media
-    media_in_back = decide_media_on_back(element, doc)
     title_suffix = '. ' if subtitle else ''
+    draft_option = 'draft,' if doc.get_metadata('media-draft', False) else ''
 
     snippet = ['% Figure generated by panflute filter "media.py"']
     snippet.append(r'{')
@@ -201,7 +286,8 @@ def figures_fenced_action(options, data, element, doc):
         snippet.append(rf'  \begin{{subfigure}}{{{panel_width}\textwidth}}')
         snippet.append(rf'    \centering')
         if panel_border: snippet.append(rf'    \fbox{{')
-        snippet.append(rf'    \includegraphics[width=0.9\linewidth]{{{panel_source}}}')
+        panel_image = doc.assets.get((panel_source, panel_width), panel_source)
+        snippet.append(rf'    \includegraphics[{draft_option}width=0.9\linewidth]{{{panel_image}}}')
         if panel_border: snippet.append(rf'    }}')
         snippet.append(rf'    \caption{{{panel_title}}}')
         snippet.append(rf'    \label{{{panel_label}}}')
@@ -216,15 +302,10 @@ def figures_fenced_action(options, data, element, doc):
 
     snippet = latexblock(snippet, files_found)
 
-    if media_in_back:
-        doc.figures.append(snippet)
-        msg = rf'\begin{{center}}\hyperref[{label}]{{[\Cref{{{label}}} about here]}}\end{{center}}'
-        return pf.RawBlock(msg, format='latex')
-    else:
-        return snippet
+    return snippet
 
 
-def stlog_fenced_action(options, data, element, doc):
+def stlog_snippet(options, doc):
 
     title, subtitle, note, label = get_adornments(options, doc, default_title='Untitled Stata Log')
 
@@ -232,10 +313,6 @@ def stlog_fenced_action(options, data, element, doc):
     size = options.get('size', 5)
 
     pagebreak = doc.get_metadata('media-pagebreak', False) # Force pagebreak after media
-    media_in_back = decide_media_on_back(element, doc)
-
-    # OVERRIDE MEDIA ON BACK
-    media_in_back = False
 
     title_suffix = '. ' if subtitle else ''
 
@@ -263,18 +340,135 @@ def stlog_fenced_action(options, data, element, doc):
     file_found = Path(source).is_file()
     snippet = latexblock(snippet, file_found)
 
-    if media_in_back:
-        doc.figures.append(snippet)
-        msg = rf'\begin{{center}}\hyperref[{label}]{{[\Cref{{{label}}} about here]}}\end{{center}}'
-        return pf.RawBlock(msg, format='latex')
+    return snippet
+
+
+# ---------------------------
+# Snippets for other formats
+# ---------------------------
+
+# With "pandocmk --formats pdf,html,docx", the filter also runs for the other formats; there
+# the media blocks become native Pandoc elements: figures, tables read by Pandoc's LaTeX reader,
+# and code blocks for Stata logs
+
+def render_elements(tag, options, doc):
+    default_title = {'table': 'Untitled Table', 'stlog': 'Untitled Stata Log'}.get(tag, 'Untitled Figure')
+    title, subtitle, note = (get_inlines(options.get(key, default), doc) for key, default in
+                             (('title', default_title), ('subtitle', ''), ('note', '')))
+    label = get_label(options, default_title=default_title)
+    # The image of a single figure is described by the figure title (converted once, so we take its text now)
+    alt = pf.stringify(pf.Span(*title)) if tag == 'figure' else None
+    caption = ([pf.Strong(*title, pf.Str('.') if subtitle else pf.Space())] if title else []) + subtitle
+
+    panels = options.get('content', []) if tag == 'figures' else [options]
+    sources = [panel.get('source') for panel in panels if isinstance(panel, dict)]
+    missing = [source for source in sources if not (source and Path(str(source)).is_file())]
+    if missing or not sources:
+        return pf.Para(pf.Emph(pf.Str(f'[{tag}: file "{missing[0] if missing else None}" not found]')))
+
+    notes = [pf.Para(pf.Emph(*note))] if note else []
+    if tag in ('figure', 'figures'):
+        images = [image_element(panel, doc, default_width=1 / len(panels) if tag == 'figures' else 1, alt=alt) for panel in panels]
+        return pf.Figure(pf.Plain(*images), *notes, caption=pf.Caption(pf.Plain(*caption)), identifier=label)
+
+    text = Path(sources[0]).read_text(encoding='utf8', errors='replace')
+    if tag == 'table':
+        # Tables are LaTeX fragments (e.g. a tabular written by Stata)
+        with span('convert_text (table)'):
+            content = pf.convert_text(text, input_format='latex')
     else:
-        return snippet
+        content = [pf.CodeBlock(text.rstrip())]
+    caption = [pf.Para(*caption)] if caption else []
+    return pf.Div(*caption, *content, *notes, identifier=label, classes=[tag])
+
+
+def image_element(panel, doc, default_width, alt=None):
+    source = panel['source']
+    width = panel.get('size', default_width)
+    if alt is not None:
+        title = [pf.Str(alt)] if alt else []
+    else:
+        title = get_inlines(panel.get('title', ''), doc)
+    if panel.get('tikz', False):
+        return pf.Emph(pf.Str('[TikZ figure'), pf.Space(), pf.Code(source), pf.Str(']'))
+    # Downsampled images are also fine here (SVGs aren't converted, see prepare_media_files())
+    image = doc.assets.get((source, width), source)
+    try:
+        attributes = {'width': f'{float(width) * 100:g}%'}
+    except (TypeError, ValueError):
+        attributes = {}
+    return pf.Image(*title, url=str(image), attributes=attributes)
+
+
+def get_inlines(text, doc):
+    '''Convert a title, subtitle or note into inlines (each call returns new elements)'''
+    if not text:
+        return []
+    if text in doc.adornments:
+        return doc.adornments.pop(text) # Elements can only be placed once
+    with span('convert_text'):
+        return block_inlines(pf.convert_text(text))
+
+
+def convert_batch_inlines(texts, doc):
+    '''As convert_batch(), but returning a dict of text:inlines pairs (for formats other than LaTeX)'''
+    texts = [text for text in texts if text.strip()]
+    if not texts:
+        return {}
+
+    marker = 'pandocmk-media-adornment'
+    separator = f'\n\n```{{=latex}}\n{marker}\n```\n\n'
+    with span('convert_text (batch)', texts=len(texts)):
+        blocks = pf.convert_text(separator.join(texts))
+    chunks = [[]]
+    for block in blocks:
+        if isinstance(block, pf.RawBlock) and block.text == marker:
+            chunks.append([])
+        else:
+            chunks[-1].append(block)
+
+    if len(chunks) != len(texts):
+        return {}
+    return {text: block_inlines(chunk) for text, chunk in zip(texts, chunks)}
 
 
 # ---------------------------
 # Aux functions
 # ---------------------------
 
+def render_media(tag, options, doc):
+    '''Build the LaTeX snippet of a media block, reusing the snippet of a previous run if possible'''
+    if not doc.is_latex:
+        return render_elements(tag, options, doc)
+
+    render = {'table': table_snippet,
+              'figure': figure_snippet,
+              'figures': figures_snippet,
+              'stlog': stlog_snippet}[tag]
+
+    key = memo_key(tag, options, doc)
+    snippet = memo_load(doc.memo_path, key) if key else None
+    if snippet is None:
+        snippet = render(options, doc)
+        if key:
+            memo_save(doc.memo_path, key, snippet)
+    return snippet
+
+
+def place_media(snippet, label, element, doc, destination):
+    '''Return the snippet, or move it to the backmatter and leave a placeholder'''
+    if not decide_media_on_back(element, doc):
+        return snippet
+    destination.append(snippet)
+    msg = rf'\begin{{center}}\hyperref[{label}]{{[\Cref{{{label}}} about here]}}\end{{center}}'
+    return pf.RawBlock(msg, format='latex')
+
+
+def get_label(options, default_title):
+    # Same as in get_adornments(), but without converting the title
+    return options.get('label', title2label(options.get('title', default_title)))
+
+
 def get_adornments(options, doc, default_title='Untitled Table'):
     '''Extract and convert media adornments'''
 
@@ -292,6 +486,96 @@ def get_adornments(options, doc, default_title='Untitled Table'):
     return title, subtitle, note, label
 
 
+def collect_adornments(doc):
+    '''Pre-pass that lists the text of all titles, subtitles and notes of the media blocks'''
+    texts = []
+
+    def action(elem, doc):
+        if isinstance(elem, pf.CodeBlock) and any(tag in elem.classes for tag in MEDIA_TAGS):
+            options = parse_options(elem)
+            # Skip blocks whose snippets will be reused from a previous run
+            tag = next(tag for tag in MEDIA_TAGS if tag in elem.classes)
+            key = memo_key(tag, options, doc)
+            if key and (doc.memo_path / f'{key}.json').is_file():
+                return
+            items = [options] + [panel for panel in options.get('content', []) if isinstance(panel, dict)]
+            for item in items:
+                texts.extend(str(item[key]) for key in ('title', 'subtitle', 'note') if item.get(key))
+
+    doc.walk(action)
+    return list(dict.fromkeys(texts))
+
+
+def collect_images(doc):
+    '''Pre-pass that lists the images of the figure blocks, with their width (as fraction of the text width)'''
+    images = []
+
+    def action(elem, doc):
+        if not isinstance(elem, pf.CodeBlock):
+            return
+        if 'figure' in elem.classes:
+            options = parse_options(elem)
+            if not options.get('tikz', False) and 'source' in options:
+                images.append((options['source'], options.get('size', 1)))
+        elif 'figures' in elem.classes:
+            panels = parse_options(elem).get('content', [])
+            for panel in panels:
+                if isinstance(panel, dict) and 'source' in panel:
+                    images.append((panel['source'], panel.get('size', 1 / len(panels))))
+
+    doc.walk(action)
+    return images
+
+
+def collect_tikz(doc):
+    '''Pre-pass that lists the sources of the TikZ figures'''
+    sources = []
+
+    def action(elem, doc):
+        if isinstance(elem, pf.CodeBlock) and 'figure' in elem.classes:
+            options = parse_options(elem)
+            if options.get('tikz', False) and 'source' in options:
+                sources.append(options['source'])
+
+    doc.walk(action)
+    return sources
+
+
+def prepare_media_files(images, sources, doc):
+    '''
+    Map each image to the file to include (converted and downsampled according to the metadata),
+    and each TikZ source to its externalized PDF (or to None to include it with \\input)
+    '''
+    draft = doc.get_metadata('media-draft', False)
+
+    # Drafts show placeholders instead of TikZ figures (as do formats other than LaTeX, which also include SVGs as they are)
+    if draft or not doc.get_metadata('media-tikz-external', False) or not doc.is_latex:
+        sources = []
+    if not doc.is_latex:
+        images = [(source, width) for source, width in images if Path(str(source)).suffix.lower() != '.svg']
+
+    if prepare_media is None or not (images or sources):
+        return {}, {}
+
+    # Drafts show no images, so we don't downsample them (but LaTeX still needs PDFs instead of SVGs)
+    dpi = None if draft else doc.get_metadata('media-dpi', None)
+    textwidth = float(doc.get_metadata('media-textwidth', 6.5))
+    quality = int(doc.get_metadata('media-quality', 85))
+    preamble = doc.get_metadata('media-tikz-preamble', r'\usepackage{tikz}')
+    engine = doc.get_metadata('media-tikz-engine', 'pdflatex')
+    return prepare_media(images, sources, dpi=dpi, textwidth=textwidth, quality=quality, preamble=preamble, engine=engine)
+
+
+def parse_options(elem):
+    '''Parse YAML options of a code block the same way pf.yaml_filter() does'''
+    raw = re.split("^([.]{3,}|[-]{3,})$", elem.text, 1, re.MULTILINE)[0]
+    try:
+        options = yaml.safe_load(raw)
+    except yaml.YAMLError:
+        return {}
+    return options if isinstance(options, dict) else {}
+
+
 def title2label(title):
     #label = pf.stringify(title)
     label = title.lower().replace(' ', '-')
@@ -301,11 +585,50 @@ def title2label(title):
 
 def convert_text(text, doc):
     '''Create function that converts text taking into account citations'''
+
+    if not text:
+        return ''
+
+    # Use the result of the batch conversion done by prepare()
+    if text in getattr(doc, 'adornments', {}):
+        return doc.adornments[text]
+
     #bibliography = doc.get_metadata('bibliography')
     #extra_args = ['--natbib', f'--bibliography="{bibliography}"'] if '@' in text and bibliography is not None else []
     extra_args = ['--natbib'] # no need to pass --bibliography
     # TODO: Allow citeproc with .pdf destination (instead of .tex destination)
-    return pf.convert_text(text=text, output_format='latex', extra_args=extra_args)
+
+    # If pandocmk started a pandoc server, use it instead of starting a new pandoc process
+    url = os.environ.get('PANDOCMK_SERVER')
+    if url and convert_with_server is not None:
+        try:
+            with span('convert_text (server)'):
+                out = convert_with_server({'text': text, 'from': 'markdown', 'to': 'latex', 'cite-method': 'natbib'}, url=url)
+            return '\n'.join(out.splitlines()) # Same as pf.convert_text()
+        except (OSError, ValueError, KeyError):
+            pass # Fall back to pandoc subprocess
+
+    with span('convert_text'):
+        return pf.convert_text(text=text, output_format='latex', extra_args=extra_args)
+
+
+def convert_batch(texts, doc):
+    '''Convert several texts with one Pandoc call; returns a dict of text:latex pairs'''
+    texts = [text for text in texts if text.strip()]
+    if not texts:
+        return {}
+
+    # Separate texts with raw LaTeX markers, which Pandoc passes through unchanged
+    marker = '%%%% pandocmk-media-adornment %%%%'
+    separator = f'\n\n```{{=latex}}\n{marker}\n```\n\n'
+    with span('convert_text (batch)', texts=len(texts)):
+        out = convert_text(separator.join(texts), doc)
+    chunks = [chunk.strip() for chunk in out.split(marker)]
+
+    # If a text broke out of its block (e.g. an unclosed fence) we don't use the batch results
+    if len(chunks) != len(texts):
+        return {}
+    return dict(zip(texts, chunks))
 
 
 def find_backmatter(doc):
@@ -316,16 +639,99 @@ def find_backmatter(doc):
 
 
 def decide_media_on_back(elem, doc):
-    media_in_back = doc.get_metadata('media-in-back', True) # Move media to back
+    # Other formats have no floats, so the media stays where it is
+    media_in_back = doc.get_metadata('media-in-back', True) and doc.is_latex # Move media to back
 
     # Don't move to back if we are already after the backmatter i.e. if we are in the appendix
     # Note that this code is fragile (doesn't work if it's nested within divs)
     if doc.backmatter_index is not None and elem.parent.tag=='Doc' and elem.index > doc.backmatter_index:
         media_in_back = False
 
+    # With "pandocmk --chunks", the backmatter can be in a previous chunk
+    if doc.get_metadata('media-chunk-after-backmatter', False) and elem.parent.tag=='Doc':
+        media_in_back = False
+
     return media_in_back
 
 
+def get_memo_path(doc):
+    '''Folder of the persistent memo of snippets (None if disabled with --no-cache or "media-cache: false")'''
+    if os.environ.get('PANDOCMK_NO_CACHE') or not doc.get_metadata('media-cache', True):
+        return None
+    root = os.environ.get('PANDOCMK_CACHE') or (Path.home() / '.cache' / 'pandocmk')
+    path = Path(root) / 'media'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def memo_key(tag, options, doc):
+    '''Hash of everything a snippet depends on: options, metadata, and the state of its source files'''
+    if doc.memo_path is None:
+        return None
+
+    sources = [options.get('source')]
+    sources.extend(panel.get('source') for panel in options.get('content', []) if isinstance(panel, dict))
+    stats = []
+    for fn in sources:
+        if fn is None:
+            continue
+        try:
+            st = os.stat(fn)
+            stats.append([fn, st.st_mtime_ns, st.st_size])
+        except OSError:
+            stats.append([fn, None, None])
+
+    metadata = [doc.get_metadata(key) for key in ('pandoc.to', 'media-pagebreak', 'media-in-back', 'media-draft')]
+    images = sorted(image for (fn, size), image in doc.assets.items() if fn in sources) # Converted or downsampled files
+    images.extend(str(doc.tikz.get(fn)) for fn in sources if fn in doc.tikz) # Externalized TikZ figures
+    filter_stamp = os.stat(__file__).st_mtime_ns # Invalidate the memo if this filter changes
+    data = json.dumps([tag, options, metadata, stats, images, filter_stamp], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+def memo_load(path, key):
+    fn = path / f'{key}.json'
+    try:
+        data = json.loads(fn.read_text(encoding='utf8'))
+        os.utime(fn) # Mark as recently used
+    except (OSError, ValueError):
+        return None
+    return latexblock([data['text']], data['raw'])
+
+
+def memo_save(path, key, snippet):
+    data = {'text': snippet.text, 'raw': isinstance(snippet, pf.RawBlock)}
+    # Other filter processes might be reading the memo, so we write to a temporary file and rename it
+    fn = path / f'{key}.json'
+    tmp_fn = path / f'{key}.{os.getpid()}.tmp'
+    tmp_fn.write_text(json.dumps(data), encoding='utf8')
+    os.replace(tmp_fn, fn)
+
+
+def memo_evict(path, max_entries=MEMO_MAX_ENTRIES):
+    '''Remove the least recently used snippets'''
+    entries = []
+    for fn in path.glob('*.json'):
+        try:
+            entries.append((fn.stat().st_mtime, fn))
+        except OSError:
+            pass # Removed by another process
+    entries.sort()
+    for _, fn in entries[:max(0, len(entries) - max_entries)]:
+        fn.unlink(missing_ok=True)
+
+
+def block_inlines(blocks):
+    '''Inlines of the paragraphs of a converted text (separated by line breaks)'''
+    inlines = []
+    for block in blocks:
+        if isinstance(block, (pf.Para, pf.Plain)):
+            if inlines:
+                inlines.append(pf.LineBreak())
+            inlines.extend(block.content)
+    return inlines
+
+
 def latexblock(code, file_found=True):
     """LaTeX block"""
     if file_found:
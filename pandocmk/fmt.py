@@ -0,0 +1,109 @@
+"""
+Code for precompiling the LaTeX preamble into a format file (.fmt)
+
+Loading packages is a large share of each LaTeX pass. With the mylatexformat package
+we dump everything before \\begin{document} into a format file once, and later passes
+start from it. Formats are cached by a hash of the preamble (which is the result of
+the style settings and the template) and of the engine and its version (formats
+dumped by another TeX release can't be loaded).
+
+See: https://ctan.org/pkg/mylatexformat
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import time
+import shutil
+import hashlib
+import functools
+from pathlib import Path
+
+from .process import run_process
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Executable that dumps formats for each engine
+INI_ENGINES = {'pdflatex': 'pdftex', 'xelatex': 'xetex'}
+
+# Seconds before we try again to precompile a preamble that failed (e.g. before mylatexformat was installed)
+FAILED_LIFETIME = 24 * 3600
+
+
+def get_format(tex_fn, pdf_engine, verbose=False, cancel=None):
+    '''Path of the precompiled format for the preamble of tex_fn (without the .fmt extension), or None'''
+    if pdf_engine not in INI_ENGINES or not shutil.which(INI_ENGINES[pdf_engine]):
+        return None
+
+    text = Path(tex_fn).read_text(encoding='utf8')
+    pos = text.find(r'\begin{document}')
+    if pos == -1:
+        return None
+
+    version = get_engine_version(INI_ENGINES[pdf_engine])
+    key = hashlib.sha256('\0'.join([pdf_engine, version, text[:pos]]).encode('utf8')).hexdigest()[:16]
+    name = f'pandocmk-{pdf_engine}-{key}'
+    path = get_format_path()
+    fmt_fn = path / f'{name}.fmt'
+    failed_fn = path / f'{name}.failed'
+
+    if fmt_fn.is_file():
+        return str(fmt_fn.with_suffix(''))
+
+    # Some preambles cannot be dumped; don't try again every time
+    try:
+        if time.time() - failed_fn.stat().st_mtime < FAILED_LIFETIME:
+            return None
+    except FileNotFoundError:
+        pass
+
+    # We dump under a name of our own and then rename it, so other builds (--jobs, --watch of folders,
+    # the daemon) never load a format that is still being written
+    tmp_name = f'{name}.{os.getpid()}'
+    cmd = [INI_ENGINES[pdf_engine], '-ini', '-interaction=nonstopmode', f'-jobname={tmp_name}',
+           f'-output-directory={path}', f'&{pdf_engine}', 'mylatexformat.ltx', str(tex_fn)]
+    if verbose:
+        print('[pandocmk] Precompiling preamble:')
+        print(f'    {" ".join(cmd)}')
+
+    try:
+        run_process(cmd, cancel=cancel)
+        os.replace(path / f'{tmp_name}.fmt', fmt_fn)
+    except IOError:
+        print(f'[pandocmk] Warning! could not precompile the preamble of "{tex_fn}"; see {path / name}.log')
+        (path / f'{tmp_name}.fmt').unlink(missing_ok=True)
+        failed_fn.touch()
+        return None
+    finally:
+        if (path / f'{tmp_name}.log').is_file():
+            os.replace(path / f'{tmp_name}.log', path / f'{name}.log')
+
+    failed_fn.unlink(missing_ok=True)
+    return str(fmt_fn.with_suffix(''))
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine_version(engine):
+    '''First line of "engine --version" (e.g. "XeTeX 3.141592653-2.6-0.999995 (TeX Live 2023)")'''
+    try:
+        return run_process([engine, '--version']).split('\n', 1)[0].strip()
+    except IOError:
+        return ''
+
+
+def get_format_path():
+    root = os.environ.get('PANDOCMK_CACHE') or (Path.home() / '.cache' / 'pandocmk')
+    path = Path(root) / 'fmt'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def engine_command(pdf_engine, fmt=None):
+    '''LaTeX engine call, starting from the precompiled format if there is one'''
+    return [pdf_engine] + ([f'-fmt={fmt}'] if fmt else [])
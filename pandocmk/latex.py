@@ -0,0 +1,167 @@
+"""
+Code for compiling .tex files with as few LaTeX passes as possible (--native)
+
+A simpler latexmk, used with --native (or if latexmk is not installed):
+
+- Auxiliary files stay in ./tmp between builds, so the first pass starts from the state left by the last build
+  (unless it failed: a pass stopped by an error removes them, so the next build starts from scratch)
+- After each pass, we hash the files that LaTeX reads back in the next one (.aux, .toc, .lof, .lot, .bbl, .out);
+  once a pass leaves them as it found them, the PDF is up to date and we stop.
+  On most edits (that don't change labels, headers or citations) a single pass is enough
+- BibTeX (or Biber, with biblatex) only runs when the citations, bibliography style or .bib files
+  changed since its last run
+
+The number of LaTeX and bibliography runs is recorded in the trace (--timeit, --trace).
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import re
+import hashlib
+from pathlib import Path
+
+from .process import run_process
+from .fmt import engine_command
+from .trace import span
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+AUX_SUFFIXES = ('.aux', '.toc', '.lof', '.lot', '.bbl', '.out')
+MAX_PASSES = 5
+
+# What BibTeX reads from the .aux file, and the .bib files listed by the .bcf file of biblatex
+BIBTEX_REGEX = re.compile(r'^\\(?:citation|bibdata|bibstyle)\{.*\}$', re.MULTILINE)
+BIBDATA_REGEX = re.compile(r'^\\bibdata\{(.*)\}$', re.MULTILINE)
+DATASOURCE_REGEX = re.compile(r'<bcf:datasource[^>]*>([^<]+)</bcf:datasource>')
+
+
+def run_passes(tex_fn, pdf_engine, tmp_path, verbose=False, cancel=None, fmt=None, max_passes=MAX_PASSES):
+    '''Compile tex_fn into tmp_path until its auxiliary files are stable; return the number of LaTeX and bibliography runs'''
+    tmp_path.mkdir(exist_ok=True)
+    stem = tex_fn.stem
+    cmd = engine_command(pdf_engine, fmt) + ['-interaction=nonstopmode', '-halt-on-error', f'-output-directory={tmp_path}', str(tex_fn)]
+
+    if verbose:
+        print('[pandocmk] LaTeX call:')
+        print(f'    {" ".join(cmd)}')
+
+    passes = bib_runs = 0
+    bib_state = read_bibliography_stamp(tmp_path, stem)
+    while True:
+        before = hash_aux_files(tmp_path, stem)
+        with span('latex pass', engine=pdf_engine, number=passes + 1):
+            try:
+                run_process(cmd, cancel=cancel)
+            except Exception:
+                # A pass stopped by an error (or cancelled) leaves truncated auxiliary files,
+                # which would make the next build fail even after the source is fixed
+                remove_aux_files(tmp_path, stem)
+                raise
+        passes += 1
+
+        # Only rerun BibTeX/Biber if what it reads changed (or its output is missing)
+        state = get_bibliography_state(tmp_path, stem)
+        if state is not None and (state != bib_state or not (tmp_path / f'{stem}.bbl').is_file()):
+            bib_state = state
+            bib_runs += 1
+            run_bibliography(state[0], tmp_path, stem, verbose=verbose, cancel=cancel)
+
+        after = hash_aux_files(tmp_path, stem)
+        if after == before:
+            break
+        if passes >= max_passes:
+            print(f'[pandocmk] Warning! auxiliary files of "{tex_fn}" still changing after {passes} LaTeX passes')
+            break
+        if verbose:
+            changed = [suffix for suffix in AUX_SUFFIXES if before.get(suffix) != after.get(suffix)]
+            print(f'[pandocmk] rerunning LaTeX ({", ".join(changed)} changed)')
+
+    if verbose:
+        print(f'[pandocmk] {passes} LaTeX pass(es) and {bib_runs} bibliography run(s)')
+    return passes, bib_runs
+
+
+def hash_aux_files(tmp_path, stem):
+    hashes = {}
+    for suffix in AUX_SUFFIXES:
+        fn = tmp_path / (stem + suffix)
+        if fn.is_file():
+            hashes[suffix] = hashlib.sha256(fn.read_bytes()).hexdigest()
+    return hashes
+
+
+def remove_aux_files(tmp_path, stem):
+    for suffix in AUX_SUFFIXES + ('.pandocmk-bib',):
+        (tmp_path / (stem + suffix)).unlink(missing_ok=True)
+
+
+def get_bibliography_state(tmp_path, stem):
+    '''Return the tool (bibtex or biber) and a hash of what it reads, or None if the document has no bibliography'''
+    bcf_fn = tmp_path / f'{stem}.bcf'
+    aux_fn = tmp_path / f'{stem}.aux'
+    if bcf_fn.is_file():
+        tool = 'biber'
+        text = bcf_fn.read_text(encoding='utf8', errors='replace')
+        bib_files = DATASOURCE_REGEX.findall(text)
+    elif aux_fn.is_file():
+        tool = 'bibtex'
+        aux = aux_fn.read_text(encoding='utf8', errors='replace')
+        text = '\n'.join(BIBTEX_REGEX.findall(aux))
+        bib_files = [fn.strip() for match in BIBDATA_REGEX.findall(aux) for fn in match.split(',')]
+    else:
+        return None
+
+    if not bib_files:
+        return None
+
+    h = hashlib.sha256(text.encode('utf8'))
+    for fn in bib_files:
+        fn = Path(fn)
+        fn = fn if fn.suffix == '.bib' else fn.with_name(fn.name + '.bib') # BibTeX gets them without extension
+        h.update(str(fn).encode('utf8'))
+        h.update(fn.read_bytes() if fn.is_file() else b'')
+    return tool, h.hexdigest()
+
+
+def read_bibliography_stamp(tmp_path, stem):
+    '''State of the bibliography when BibTeX/Biber last ran (in an earlier build)'''
+    try:
+        tool, digest = (tmp_path / f'{stem}.pandocmk-bib').read_text(encoding='utf8').split()
+        return tool, digest
+    except (OSError, ValueError):
+        return None
+
+
+def run_bibliography(tool, tmp_path, stem, verbose=False, cancel=None):
+    if tool == 'biber':
+        cmd = ['biber', f'--input-directory={tmp_path}', f'--output-directory={tmp_path}', stem]
+    else:
+        cmd = ['bibtex', str(tmp_path / stem)]
+
+    if verbose:
+        print(f'[pandocmk] {tool} call:')
+        print(f'    {" ".join(cmd)}')
+
+    stamp_fn = tmp_path / f'{stem}.pandocmk-bib'
+    stamp_fn.unlink(missing_ok=True)
+    bbl_fn = tmp_path / f'{stem}.bbl'
+    bbl_before = bbl_fn.stat().st_mtime_ns if bbl_fn.is_file() else None
+    with span(tool):
+        try:
+            run_process(cmd, cancel=cancel)
+        except IOError as e:
+            # BibTeX also fails on warnings (e.g. a missing entry); LaTeX then shows "[?]" for those citations.
+            # If it still wrote the .bbl, running it again on the same input won't change anything
+            print(f'[pandocmk] Warning! {tool} failed: {str(e).strip()}')
+            if not bbl_fn.is_file() or bbl_fn.stat().st_mtime_ns == bbl_before:
+                return
+
+    state = get_bibliography_state(tmp_path, stem)
+    if state is not None:
+        stamp_fn.write_text(' '.join(state), encoding='utf8')
@@ -10,11 +10,8 @@ Code for interfacing with the user through the CLI
 import yaml
 from pathlib import Path
 
-# Used to access static files (i.e. .yaml files)
-# https://stackoverflow.com/a/20885799/3977107
-from importlib.resources import read_text
-
-from .utils import write_metadata, get_filename
+from .utils import write_metadata
+from .registry import get_style
 
 # ---------------------------
 # Functions
@@ -32,39 +29,19 @@ def get_pandoc_options(args, md_fn, verbose=False, strict=False):
                'pdf-engine': 'xelatex',
                'output': None}
 
-    # Load default YAML styles
-    default_styles = read_text("pandocmk", "default-styles.yaml")
-    default_styles = yaml.safe_load(default_styles)
-
     # Get markdown YAML header
     meta = get_yaml_metadata(md_fn)
     style = meta.get('style', 'default') # If style does not exist, use 'default'
 
-    # Override defaults with YAML styles
-    if style in default_styles:
+    # Override defaults with YAML styles (see registry.py)
+    style_settings = get_style(style, md_fn, verbose=verbose)
+    if style_settings is not None:
         if verbose:
             print(f'[pandocmk] {style=}')
-        style_settings = default_styles[style]
-
-        # Replace templates with those in the pandocmk template folder
-        # Note that we only do so for the default options, so users can change this
-        template = style_settings.get('pandoc', {}).get('template')
-        if template:
-            template = get_filename(template, subfolder='templates')
-            style_settings['pandoc']['template'] = template
-
-        # Same for filters
-        filters = style_settings.get('pandoc', {}).get('filter')
-        if filters:
-            filters = [get_filename(filter, subfolder='filters') for filter in filters] 
-            style_settings['pandoc']['filter'] = filters
 
         # Override Pandoc CLI options
         options.update(style_settings.get('pandoc', {}))
 
-        # Flatten YAML file (when we include we often end up with lists-of-lists which look ugly)
-        style_settings = flatten_dict(style_settings)
-
         # Add metadata YAML file
         temp_yaml_fn = write_metadata(md_fn, style_settings)
         options['metadata-file'] = str(temp_yaml_fn)
@@ -106,17 +83,6 @@ def get_pandoc_options(args, md_fn, verbose=False, strict=False):
     return options
 
 
-def flatten_dict(d):
-    assert isinstance(d, dict)
-    for k, v in d.items():
-        if isinstance(v, dict):
-            d[k] = flatten_dict(v)
-        elif isinstance(v, list):
-            v = [item if isinstance(item, list) else [item] for item in v]
-            d[k] = [subitem for item in v for subitem in item]
-    return d
-
-
 def arguments2options(args):
     """
     Convert CLI arguments into a dict
@@ -142,7 +108,7 @@ def options2arguments(options):
     for k, v in options.items():
         # If there are multiple filters, we need to expand them to multiple arguments:
         # filter=[a,b] --> "-F a -F b"
-        if k in ('filter', 'metadata-file') and isinstance(v, (list, tuple)):  # not very robust
+        if k in ('filter', 'metadata-file', 'metadata') and isinstance(v, (list, tuple)):  # not very robust
             for vv in v:
                 args.append(f'--{k}={vv}')
         else:
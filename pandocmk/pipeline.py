@@ -0,0 +1,241 @@
+"""
+Code for splitting a Pandoc call into a reader stage and writer stages
+
+The reader stage parses the markdown and runs the JSON filters once,
+producing the filtered AST (as JSON text). Each writer stage then reads
+that AST from stdin, so writing both .tex and .pdf doesn't parse and filter twice.
+
+Filters often depend on the output format (filters/media.py writes LaTeX for .tex and .pdf
+outputs, and Pandoc elements for the others), so with --formats the markdown is parsed once
+but the filters run once for the LaTeX-based outputs and once for all the others.
+
+Panflute filters that expose main(doc=None) (such as filters/media.py)
+are imported and run inside this process instead of a new Python interpreter.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import io
+import os
+import re
+import sys
+import json
+import shutil
+import functools
+import threading
+import contextlib
+import importlib.util
+from pathlib import Path
+
+from .metadata import options2arguments
+from .process import run_process
+from .trace import span
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Options used when reading the markdown; metadata options end up inside the AST
+READER_OPTIONS = ('from', 'metadata', 'metadata-file', 'bibliography', 'csl', 'abbreviations',
+                  'default-image-extension', 'file-scope', 'indented-code-classes', 'shift-heading-level-by',
+                  'strip-comments', 'tab-stop', 'track-changes', 'extract-media', 'resource-path', 'data-dir')
+
+# Options not needed again when writing (citeproc still needs the bibliography)
+AST_OPTIONS = ('from', 'metadata', 'metadata-file', 'filter', 'lua-filter')
+
+# Outputs written from the AST filtered for LaTeX; the others share a second filter pass
+LATEX_EXTENSIONS = ('tex', 'pdf')
+
+# Pandoc writers of the file extensions that aren't named after them
+EXTENSION_WRITERS = {'md': 'markdown', 'txt': 'plain', 'htm': 'html', 'tei': 'tei'}
+
+# Pandoc runs filters with these extensions through an interpreter
+INTERPRETERS = {'.py': [sys.executable], '.hs': ['runhaskell'], '.pl': ['perl'], '.rb': ['ruby'],
+                '.php': ['php'], '.js': ['node'], '.r': ['Rscript']}
+
+
+# A filter can run in-process if it has a main(doc=None) function and doesn't run itself on import
+MAIN_REGEX = re.compile(r'^def main\(\s*doc\s*=\s*None\s*\)', re.MULTILINE)
+GUARD_REGEX = re.compile(r'^if __name__ == .__main__.:', re.MULTILINE)
+
+_filter_modules = {}
+
+# In-process filters of concurrent filter passes share os.environ (see filter_environment())
+_environment_lock = threading.Lock()
+_environment_users = 0
+_saved_environment = {}
+
+
+def can_share_ast(options):
+    # Lua filters can only run inside pandoc, and must keep their order relative to JSON filters
+    return not options.get('lua-filter')
+
+
+def shared_ast(pandoc_options, md_fn, verbose=False, cancel=None):
+    '''
+    Return a function ast(ext) that gives the filtered AST of md_fn (as JSON text) for an output extension
+
+    Each stage (reading, and the filters of each group of formats) runs once, when first needed;
+    writers that need a stage while another writer runs it wait for its result
+    '''
+    filters = pandoc_options.get('filter') or []
+    filters = filters if isinstance(filters, (list, tuple)) else [filters]
+    lock = threading.RLock()
+    results = {}
+
+    def stage(key, compute):
+        with lock:
+            if key not in results:
+                results[key] = compute()
+            return results[key]
+
+    def read():
+        return stage('read', lambda: read_markdown(pandoc_options, md_fn, verbose=verbose, cancel=cancel))
+
+    def ast(ext='tex'):
+        if not filters:
+            return read()
+        if ext in LATEX_EXTENSIONS:
+            family, to = 'latex', pandoc_options.get('to', 'latex')
+        else:
+            # The first of the other formats gives the target format of their filter pass
+            with lock:
+                family, to = 'other', results.setdefault('other', EXTENSION_WRITERS.get(ext, ext))
+        return stage(('filters', family), lambda: run_filters(read(), filters, to=to, verbose=verbose, cancel=cancel))
+
+    return ast
+
+
+def read_markdown(pandoc_options, md_fn, verbose=False, cancel=None):
+    '''Parse the markdown file; return the AST (before filters) as JSON text'''
+    options = {k: v for k, v in pandoc_options.items() if k in READER_OPTIONS}
+    options['to'] = 'json'
+    args = options2arguments(options) + [str(md_fn)]
+
+    if verbose:
+        print('[pandocmk] Pandoc reader call:')
+        print(f'    pandoc {" ".join(args)}')
+
+    with span('pandoc (read)', args=' '.join(args)):
+        return run_process(['pandoc'] + args, cancel=cancel)
+
+
+def writer_options(pandoc_options):
+    '''Options of a writer stage that reads the AST from stdin'''
+    options = {k: v for k, v in pandoc_options.items() if k not in AST_OPTIONS}
+    return {'from': 'json', **options}
+
+
+def has_inprocess_filters(options):
+    filters = options.get('filter') or []
+    filters = filters if isinstance(filters, (list, tuple)) else [filters]
+    return any(load_filter(fn) is not None for fn in filters)
+
+
+def run_filters(ast, filters, to, verbose=False, cancel=None):
+    '''Run JSON filters as Pandoc would: AST in stdin and out through stdout, target format as argument'''
+    env = {'PANDOC_VERSION': get_pandoc_version(), 'PANDOC_READER_OPTIONS': json.dumps({})}
+    doc = None # Consecutive in-process filters share the panflute Doc, so we only convert to JSON when needed
+
+    for fn in filters:
+        module = load_filter(fn)
+
+        if module is not None:
+            if verbose:
+                print(f'[pandocmk] In-process filter call: {fn}')
+            if doc is None:
+                import panflute
+                with span('json to panflute'):
+                    doc = panflute.load(io.StringIO(ast))
+                doc.format = to
+            with span(f'filter {Path(fn).name}', mode='in-process'), filter_environment(env):
+                doc = module.main(doc=doc)
+            continue
+
+        if doc is not None:
+            ast = dump_doc(doc)
+            doc = None
+        cmd = filter_command(fn) + [to]
+        if verbose:
+            print(f'[pandocmk] Filter call: {" ".join(cmd)}')
+        with span(f'filter {Path(fn).name}', mode='subprocess'):
+            ast = run_process(cmd, input=ast, env=env, cancel=cancel)
+
+    return ast if doc is None else dump_doc(doc)
+
+
+@contextlib.contextmanager
+def filter_environment(env):
+    '''Set the variables that Pandoc passes to filters in os.environ, for filters that run in this process'''
+    global _environment_users
+    with _environment_lock:
+        if _environment_users == 0:
+            _saved_environment.update((k, os.environ.get(k)) for k in env)
+            os.environ.update(env)
+        _environment_users += 1
+    try:
+        yield
+    finally:
+        with _environment_lock:
+            _environment_users -= 1
+            if _environment_users == 0:
+                for k, v in _saved_environment.items():
+                    if v is None:
+                        os.environ.pop(k, None)
+                    else:
+                        os.environ[k] = v
+                _saved_environment.clear()
+
+
+def dump_doc(doc):
+    import panflute
+    with span('panflute to json'), io.StringIO() as f:
+        panflute.dump(doc, f)
+        return f.getvalue()
+
+
+def load_filter(fn):
+    '''Import a panflute filter that can run in-process; return None for any other filter'''
+    path = Path(fn)
+    if path.suffix.lower() != '.py' or not path.is_file():
+        return None
+
+    # Reload the filter if it changed (e.g. in watch mode)
+    path = path.resolve()
+    stamp = path.stat().st_mtime_ns
+    if (path, stamp) in _filter_modules:
+        return _filter_modules[path, stamp]
+
+    module = None
+    source = path.read_text(encoding='utf8')
+    if MAIN_REGEX.search(source) and GUARD_REGEX.search(source):
+        spec = importlib.util.spec_from_file_location(f'pandocmk_filter_{path.stem}', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+    _filter_modules[path, stamp] = module
+    return module
+
+
+def filter_command(fn):
+    path = Path(fn)
+    if not path.is_file():
+        found = shutil.which(fn)
+        if found is None:
+            raise IOError(f'Could not find executable "{fn}"')
+        return [found]
+
+    interpreter = INTERPRETERS.get(path.suffix.lower())
+    if interpreter is None or (os.name == 'posix' and os.access(path, os.X_OK) and path.suffix.lower() != '.py'):
+        return [str(path)]
+    return interpreter + [str(path)]
+
+
+@functools.lru_cache(maxsize=None)
+def get_pandoc_version():
+    out = run_process(['pandoc', '--version'])
+    return out.split()[1] # "pandoc 3.1.2 ..."
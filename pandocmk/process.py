@@ -0,0 +1,221 @@
+"""
+Code for running external tools (pandoc, latexmk) in a way that can be cancelled
+
+run_process() blocks until the tool ends. The asyncio API (arun_process, gather_stages, run_async)
+runs several tools at the same time, streams their output while they run, and supports timeouts:
+
+    stages = [arun_process(['pandoc', ...]), arun_process(['pandoc', ...])]
+    tex_out, pdf_out = run_async(gather_stages(*stages), cancel=cancel)
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import sys
+import codecs
+import signal
+import subprocess
+
+# Note: asyncio is imported inside the functions that need it, as it takes a while (see benchmarks/startup.py)
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+class BuildCancelled(Exception):
+    '''Raised when a build is cancelled because a newer one was requested'''
+    pass
+
+
+def run_process(cmd, cancel=None, input=None, env=None, poll=0.1):
+    '''
+    Run a command and return its stdout, raising IOError (with stderr as message) if it fails
+
+    The optional -input- text is sent to stdin, and -env- adds environment variables
+
+    If the -cancel- event (threading.Event) gets set while the command runs,
+    the process and its children (filters, LaTeX engines) are killed and BuildCancelled is raised
+    '''
+
+    # Start a new process group so we can also kill the processes started by this one
+    kwargs = dict(start_new_session=True) if os.name == 'posix' else dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+
+    if env is not None:
+        kwargs['env'] = {**os.environ, **env}
+
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    except FileNotFoundError:
+        raise IOError(f'Could not find executable "{cmd[0]}"')
+
+    # Retrying communicate() after a timeout does not lose any output (but input can only be sent once)
+    input = input.encode('utf-8') if input is not None else None
+    while True:
+        try:
+            out, err = proc.communicate(input=input, timeout=poll if cancel is not None else None)
+            break
+        except subprocess.TimeoutExpired:
+            input = None
+            if cancel.is_set():
+                kill_process(proc)
+                raise BuildCancelled(cmd[0])
+
+    out = out.decode('utf-8', errors='replace')
+    err = err.decode('utf-8', errors='replace')
+
+    if err:
+        print(err, end='', file=sys.stderr)
+    if proc.returncode != 0:
+        raise IOError(err or f'{cmd[0]} failed with exit code {proc.returncode}')
+
+    return out
+
+
+def kill_process(proc):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+    proc.communicate()
+
+
+# ---------------------------
+# Asyncio API
+# ---------------------------
+
+def print_stderr(stream, line):
+    '''Default output handler: show stderr (warnings, errors) as soon as it is written'''
+    if stream == 'stderr':
+        print(line, end='', file=sys.stderr, flush=True)
+
+
+def print_output(stream, line):
+    '''Output handler that shows everything (e.g. with --verbose)'''
+    print(line, end='', file=sys.stderr if stream == 'stderr' else sys.stdout, flush=True)
+
+
+async def arun_process(cmd, input=None, env=None, timeout=None, on_output=print_stderr):
+    '''
+    Coroutine that runs a command and returns its stdout, raising IOError (with stderr as message) if it fails
+
+    Each line of output is sent to on_output(stream, line), with stream either 'stdout' or 'stderr'.
+    If the command takes more than -timeout- seconds, or the coroutine is cancelled,
+    the process and its children are killed
+    '''
+    import asyncio
+
+    kwargs = dict(start_new_session=True) if os.name == 'posix' else dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    if env is not None:
+        kwargs['env'] = {**os.environ, **env}
+
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE, **kwargs)
+    except FileNotFoundError:
+        raise IOError(f'Could not find executable "{cmd[0]}"')
+
+    output = {'stdout': [], 'stderr': []}
+
+    async def read(stream, name):
+        # Read in blocks, as lines can be very long (e.g. Pandoc's JSON output)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ''
+        while True:
+            data = await stream.read(2 ** 16)
+            text = decoder.decode(data, final=not data)
+            output[name].append(text)
+            if on_output is not None:
+                *lines, pending = (pending + text).split('\n')
+                for line in lines:
+                    on_output(name, line + '\n')
+                if not data and pending:
+                    on_output(name, pending)
+            if not data:
+                break
+
+    async def write():
+        if input is not None:
+            proc.stdin.write(input.encode('utf-8'))
+            try:
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass # The process exited without reading all its input; its exit code tells what happened
+        proc.stdin.close()
+
+    try:
+        await asyncio.wait_for(asyncio.gather(write(), read(proc.stdout, 'stdout'), read(proc.stderr, 'stderr'), proc.wait()), timeout)
+    except asyncio.TimeoutError:
+        await akill_process(proc)
+        raise IOError(f'{cmd[0]} did not finish in {timeout} seconds')
+    except asyncio.CancelledError:
+        await akill_process(proc)
+        raise
+
+    out = ''.join(output['stdout'])
+    err = ''.join(output['stderr'])
+    if proc.returncode != 0:
+        raise IOError(err or f'{cmd[0]} failed with exit code {proc.returncode}')
+    return out
+
+
+async def akill_process(proc):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+async def gather_stages(*stages, cancel_on_error=True):
+    '''
+    Run independent stages (coroutines) at the same time and return their results
+
+    If one fails, its error is raised after cancelling the others (or after they end, if not -cancel_on_error-)
+    '''
+    import asyncio
+
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION if cancel_on_error else asyncio.ALL_COMPLETED)
+    finally:
+        # Also reached if we are cancelled ourselves
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in tasks:
+        if task in done and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
+def run_async(coro, cancel=None, poll=0.1):
+    '''
+    Run a coroutine from synchronous code (e.g. a build thread) and return its result
+
+    If the -cancel- event (threading.Event) gets set, the coroutine is cancelled (killing its processes)
+    and BuildCancelled is raised
+    '''
+    import asyncio
+
+    async def main():
+        task = asyncio.ensure_future(coro)
+        while cancel is not None and not task.done():
+            await asyncio.wait([task], timeout=poll)
+            if cancel.is_set() and not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise BuildCancelled()
+        return await task
+
+    return asyncio.run(main())
@@ -0,0 +1,164 @@
+"""
+Registry of styles, compiled once and cached
+
+Styles are read from these YAML files (later files override earlier ones):
+
+1. default-styles.yaml in the pandocmk package
+2. *.yaml files in ~/.config/pandocmk/styles (user styles)
+3. *.yaml files in the folders listed in the PANDOCMK_STYLES environment variable
+4. *.yaml files in the .pandocmk folder next to the markdown file (project styles)
+
+Compiling a style means resolving its YAML anchors and merges, its template and filter paths,
+and flattening its lists. The compiled registry is pickled in the cache folder, keyed by the
+path, size and mtime of every YAML file, so later builds (and watch iterations) don't parse YAML.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import copy
+import pickle
+import hashlib
+from pathlib import Path
+
+import yaml
+
+# Use the C loader if PyYAML was compiled with libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from .version import __version__
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+PACKAGE_PATH = Path(__file__).resolve().parent
+USER_STYLE_PATH = Path.home() / '.config' / 'pandocmk' / 'styles'
+PROJECT_STYLE_FOLDER = '.pandocmk'
+
+STYLES_MAX_ENTRIES = 20 # Compiled registries kept in the cache folder (one per set of style files)
+
+_registries = {} # In-memory cache, for watch mode and batch builds
+
+
+def get_style(style, md_fn, verbose=False):
+    '''Settings of a style (a copy that can be modified), or None if the style does not exist'''
+    styles = load_styles(md_fn, verbose=verbose)
+    settings = styles.get(style)
+    return copy.deepcopy(settings) if settings is not None else None
+
+
+def get_style_files(md_fn):
+    folders = [USER_STYLE_PATH]
+    folders.extend(Path(path) for path in os.environ.get('PANDOCMK_STYLES', '').split(os.pathsep) if path)
+    folders.append(Path(md_fn).resolve().parent / PROJECT_STYLE_FOLDER)
+
+    files = [PACKAGE_PATH / 'default-styles.yaml']
+    for folder in folders:
+        if folder.is_dir():
+            files.extend(sorted(folder.glob('*.yaml')))
+    return files
+
+
+def load_styles(md_fn, verbose=False):
+    files = get_style_files(md_fn)
+    stamp = tuple((str(fn), fn.stat().st_mtime_ns, fn.stat().st_size) for fn in files)
+
+    if stamp in _registries:
+        return _registries[stamp]
+
+    key = hashlib.sha256(repr((__version__, stamp)).encode('utf8')).hexdigest()[:16]
+    root = os.environ.get('PANDOCMK_CACHE') or (Path.home() / '.cache' / 'pandocmk')
+    cache_fn = Path(root) / f'styles-{key}.pickle'
+
+    try:
+        with cache_fn.open('rb') as fh:
+            styles = pickle.load(fh)
+        os.utime(cache_fn) # Mark as recently used (see evict_registries())
+    except (OSError, pickle.UnpicklingError, EOFError):
+        if verbose:
+            print(f'[pandocmk] compiling styles from {len(files)} file(s)')
+        styles = compile_styles(files)
+        try:
+            cache_fn.parent.mkdir(parents=True, exist_ok=True)
+            tmp_fn = cache_fn.with_name(f'{cache_fn.name}.{os.getpid()}.tmp')
+            with tmp_fn.open('wb') as fh:
+                pickle.dump(styles, fh)
+            os.replace(tmp_fn, cache_fn)
+            evict_registries(cache_fn.parent)
+        except OSError:
+            pass # A read-only cache folder is not an error
+
+    _registries[stamp] = styles
+    return styles
+
+
+def evict_registries(folder, max_entries=STYLES_MAX_ENTRIES):
+    '''Remove the least recently used compiled registries (e.g. of style files edited since, or older pandocmk versions)'''
+    entries = []
+    for fn in folder.glob('styles-*.pickle'):
+        try:
+            entries.append((fn.stat().st_mtime, fn))
+        except OSError: # Removed by another process
+            continue
+    for _, fn in sorted(entries, reverse=True)[max_entries:]:
+        fn.unlink(missing_ok=True)
+
+
+def compile_styles(files):
+    styles = {}
+    for fn in files:
+        data = yaml.load(fn.read_text(encoding='utf8'), Loader=SafeLoader) or {}
+        for name, settings in data.items():
+            # Skip entries that only exist to be used as anchors (e.g. math-header-includes)
+            if not isinstance(settings, dict):
+                continue
+            styles[name] = compile_style(settings, fn.parent)
+    return styles
+
+
+def compile_style(settings, base_path):
+    # Anchors share objects between styles, so we work on a copy
+    settings = copy.deepcopy(settings)
+    pandoc = settings.get('pandoc') or {}
+
+    # Replace templates with those in the pandocmk template folder
+    # Note that we only do so for the default options, so users can change this
+    template = pandoc.get('template')
+    if template:
+        pandoc['template'] = resolve_filename(template, 'templates', base_path)
+
+    # Same for filters
+    filters = pandoc.get('filter')
+    if filters:
+        pandoc['filter'] = [resolve_filename(filter, 'filters', base_path) for filter in filters]
+
+    # Flatten YAML file (when we include we often end up with lists-of-lists which look ugly)
+    return flatten_dict(settings)
+
+
+def resolve_filename(fn, subfolder, base_path):
+    '''Look for a file next to the style file, then in the pandocmk folders; else return it unchanged'''
+    for path in (base_path, base_path / subfolder, PACKAGE_PATH / subfolder):
+        fixed_fn = (path / fn).resolve()
+        if fixed_fn.is_file():
+            return str(fixed_fn)
+    return fn
+
+
+def flatten_dict(d):
+    assert isinstance(d, dict)
+    for k, v in d.items():
+        if isinstance(v, dict):
+            d[k] = flatten_dict(v)
+        elif isinstance(v, list):
+            v = [item if isinstance(item, list) else [item] for item in v]
+            d[k] = [subitem for item in v for subitem in item]
+    return d
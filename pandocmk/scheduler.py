@@ -0,0 +1,83 @@
+"""
+Code for scheduling rebuilds in watch mode
+
+Bursts of changes are coalesced into a single build, which runs on a worker thread.
+If a change arrives while a build is running, that build is cancelled
+(killing pandoc/latexmk) so only the latest state of the inputs is built.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import time
+import threading
+
+from .process import BuildCancelled
+
+
+# ---------------------------
+# Classes
+# ---------------------------
+
+class BuildScheduler:
+
+    def __init__(self, build, quiet=0.3, name='build', verbose=False):
+        self.build = build # Function that receives a threading.Event that is set if the build gets cancelled
+        self.quiet = quiet # Seconds without changes before we start building
+        self.name = name
+        self.verbose = verbose
+        self.cond = threading.Condition()
+        self.pending = False
+        self.last_request = 0
+        self.cancel = None # Event of the running build, if any
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=f'pandocmk-{name}', daemon=True)
+        self.thread.start()
+
+    def request(self):
+        '''Ask for a build; cancels the running build if there is one'''
+        with self.cond:
+            self.pending = True
+            self.last_request = time.monotonic()
+            if self.cancel is not None:
+                self.cancel.set()
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            if self.cancel is not None:
+                self.cancel.set()
+            self.cond.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+
+                # Wait until there are no new requests for -quiet- seconds
+                while not self.stopped:
+                    remaining = self.last_request + self.quiet - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                if self.stopped:
+                    return
+                self.pending = False
+                cancel = self.cancel = threading.Event()
+
+            try:
+                self.build(cancel)
+            except BuildCancelled:
+                print(f'[pandocmk] {self.name}: build cancelled (inputs changed)')
+            except Exception as e:
+                # Keep watching after a failed build; the next change might fix it
+                print(f'[pandocmk] {self.name}: build failed: {type(e).__name__}: {e}')
+            finally:
+                with self.cond:
+                    self.cancel = None
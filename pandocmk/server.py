@@ -0,0 +1,174 @@
+"""
+Optional backend that sends conversions to a local "pandoc server" over HTTP
+
+This avoids starting a new pandoc process for every conversion.
+The server cannot run filters or read files: we send it the contents of the files it needs
+(templates, metadata files), or the AST already filtered by pipeline.py. Anything else
+(and any error talking to the server) falls back to a pandoc subprocess.
+
+See: https://pandoc.org/pandoc-server.html
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import atexit
+import socket
+import subprocess
+from pathlib import Path
+
+import yaml
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Filter processes inherit this variable, so they can send their conversions to the same server
+SERVER_ENV_VAR = 'PANDOCMK_SERVER'
+
+# Pandoc options that have an equivalent in the server API (options whose value is a file are read here)
+SERVER_OPTIONS = {'from', 'to', 'standalone', 'template', 'natbib', 'biblatex', 'citeproc',
+                  'number-sections', 'toc', 'table-of-contents', 'wrap', 'columns', 'top-level-division',
+                  'metadata-file'}
+
+# Options that don't change the .tex output (the server only writes LaTeX for us, see core.py)
+IGNORED_OPTIONS = {'output', 'pdf-engine', 'pdf-engine-opt'}
+
+# Seconds to wait for a conversion; afterwards we run pandoc instead
+SERVER_TIMEOUT = 120
+
+_server = None
+
+
+def start_server(verbose=False, timeout=5):
+    '''Start one pandoc server for this session and return its URL (None if unavailable)'''
+    global _server
+
+    if _server is not None:
+        return os.environ.get(SERVER_ENV_VAR)
+
+    # Pandoc >= 2.18 has "pandoc server"; some distributions ship it as "pandoc-server"
+    if shutil.which('pandoc'):
+        cmd = ['pandoc', 'server']
+    elif shutil.which('pandoc-server'):
+        cmd = ['pandoc-server']
+    else:
+        return None
+
+    import urllib.request
+
+    port = find_free_port()
+    url = f'http://127.0.0.1:{port}'
+    proc = subprocess.Popen(cmd + [f'--port={port}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait until the server answers, or give up
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            with urllib.request.urlopen(url + '/version', timeout=1) as response:
+                version = response.read().decode('utf8')
+            _server = proc
+            os.environ[SERVER_ENV_VAR] = url
+            atexit.register(stop_server)
+            if verbose:
+                print(f'[pandocmk] pandoc server {version} listening on {url}')
+            return url
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    if verbose:
+        print('[pandocmk] Warning! could not start pandoc server; using pandoc subprocesses')
+    return None
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.terminate()
+        _server.wait()
+        _server = None
+        os.environ.pop(SERVER_ENV_VAR, None)
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_server_url():
+    return os.environ.get(SERVER_ENV_VAR)
+
+
+def convert(params, url=None, timeout=SERVER_TIMEOUT):
+    '''
+    Convert with the server; params are the JSON fields of the server API (text, from, to, ...)
+
+    Raises OSError if the server fails or doesn't answer, and ValueError/KeyError if its reply is malformed.
+    Messages go to stderr, as filters (filters/media.py) send the document to Pandoc through stdout
+    '''
+    import urllib.request
+
+    url = url or get_server_url()
+    data = json.dumps(params).encode('utf8')
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    request = urllib.request.Request(url, data=data, headers=headers, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        result = json.loads(response.read().decode('utf8'))
+    for message in result.get('messages', []):
+        print(f'[pandoc] {message.get("verbosity", "")} {message.get("message", "")}', file=sys.stderr)
+    return result['output']
+
+
+def options2params(options, md_fn, text=None):
+    '''
+    Translate Pandoc options into server parameters; return None if some option is not supported
+
+    -text- is the input (by default, the contents of md_fn); e.g. the filtered AST with "from: json"
+    '''
+    if any(k not in SERVER_OPTIONS | IGNORED_OPTIONS for k in options):
+        return None
+
+    params = {'text': Path(md_fn).read_text(encoding='utf8') if text is None else text}
+    for k, v in options.items():
+        if k in IGNORED_OPTIONS:
+            continue
+        elif k == 'metadata-file':
+            # The server cannot read files, so the metadata goes before the document as YAML blocks
+            # (JSON is valid YAML). Pandoc gives precedence to later blocks, so the header of the
+            # document still overrides these values, as with --metadata-file
+            if not str(options.get('from', 'markdown')).startswith('markdown'):
+                return None
+            blocks = []
+            for fn in v if isinstance(v, (list, tuple)) else [v]:
+                metadata = yaml.safe_load(Path(fn).read_text(encoding='utf8'))
+                if not isinstance(metadata, dict):
+                    return None
+                blocks.append(f'---\n{json.dumps(metadata, default=str)}\n...\n\n')
+            params['text'] = ''.join(blocks) + params['text']
+        elif k in ('natbib', 'biblatex'):
+            params['cite-method'] = k
+        elif k == 'template':
+            # The server cannot read files, so we send the template itself
+            params['template'] = Path(v).read_text(encoding='utf8')
+        elif k == 'columns':
+            params[k] = int(v)
+        elif k == 'number-sections':
+            params['number-sections'] = bool(v)
+        elif k == 'table-of-contents':
+            params['toc'] = bool(v)
+        else:
+            params[k] = v
+    return params
+
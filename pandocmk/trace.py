@@ -0,0 +1,156 @@
+"""
+Code for tracing where build time goes
+
+Build phases are wrapped in span() blocks. When tracing is enabled (--timeit or --trace)
+each span is recorded, and at the end we can print a summary table or write a
+Chrome trace file (open it with chrome://tracing or https://ui.perfetto.dev).
+When tracing is disabled, span() does nothing.
+
+Worker processes (--jobs, --watch of folders) send their events back with their results.
+Other processes that record spans, such as filters run by Pandoc, write their events
+to a file in a folder shared through an environment variable when they exit,
+and the main process merges those files before showing or writing the trace.
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Worker processes (--jobs) and filters inherit these variables
+TRACE_ENV_VAR = 'PANDOCMK_TRACE'
+TRACE_DIR_ENV_VAR = 'PANDOCMK_TRACE_DIR'
+
+_events = []
+_lock = threading.Lock()
+_owner = False # True in the process that shows or writes the trace
+_dump_registered = False
+
+
+def enable():
+    global _owner
+    os.environ[TRACE_ENV_VAR] = '1'
+    os.environ[TRACE_DIR_ENV_VAR] = tempfile.mkdtemp(prefix='pandocmk-trace-')
+    _owner = True
+    atexit.register(remove_trace_dir)
+
+
+def is_enabled():
+    return os.environ.get(TRACE_ENV_VAR) == '1'
+
+
+@contextmanager
+def span(name, cat='pandocmk', **args):
+    '''
+    Record how long the enclosed block takes; args are shown in the trace viewer
+
+    The block receives the args dict, so it can add results (e.g. number of passes)
+    '''
+    if not is_enabled():
+        yield {}
+        return
+
+    ts = time.time() * 1e6 # Wall clock, so events of different processes line up
+    tic = time.perf_counter()
+    try:
+        yield args
+    finally:
+        dur = (time.perf_counter() - tic) * 1e6
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': ts, 'dur': dur,
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {k: str(v) for k, v in args.items()}}
+        with _lock:
+            _events.append(event)
+        register_dump()
+
+
+def register_dump():
+    '''In processes started by others (filters run by Pandoc), save the events when exiting'''
+    global _dump_registered
+    if _owner or _dump_registered or not os.environ.get(TRACE_DIR_ENV_VAR):
+        return
+    _dump_registered = True
+    atexit.register(dump_events)
+
+
+def dump_events():
+    path = os.environ.get(TRACE_DIR_ENV_VAR)
+    events = get_events()
+    if not path or not events or not os.path.isdir(path):
+        return
+    # Write to a temporary name first, so merge_events() never reads a partial file
+    fd, tmp_fn = tempfile.mkstemp(dir=path, prefix='.', suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf8') as fh:
+        json.dump(events, fh)
+    os.replace(tmp_fn, tmp_fn[:-len('.tmp')] + '.json')
+
+
+def merge_events():
+    '''Add the events saved by other processes (see dump_events())'''
+    path = os.environ.get(TRACE_DIR_ENV_VAR)
+    if not _owner or not path or not os.path.isdir(path):
+        return
+    for fn in sorted(os.listdir(path)):
+        if fn.endswith('.json'):
+            fn = os.path.join(path, fn)
+            try:
+                with open(fn, encoding='utf8') as fh:
+                    add_events(json.load(fh))
+            except (OSError, ValueError):
+                pass
+            os.remove(fn)
+
+
+def remove_trace_dir():
+    import shutil
+    path = os.environ.get(TRACE_DIR_ENV_VAR)
+    if _owner and path:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def get_events():
+    with _lock:
+        return list(_events)
+
+
+def add_events(events):
+    '''Add the events recorded by another process'''
+    with _lock:
+        _events.extend(events)
+
+
+def write_chrome_trace(fn):
+    merge_events()
+    data = {'traceEvents': get_events(), 'displayTimeUnit': 'ms'}
+    with open(fn, 'w', encoding='utf8') as fh:
+        json.dump(data, fh)
+    print(f'[pandocmk] trace written to "{fn}"')
+
+
+def print_summary():
+    '''Table with the number of calls and the time spent in each phase'''
+    merge_events()
+    totals = {}
+    for event in get_events():
+        calls, total = totals.get(event['name'], (0, 0))
+        totals[event['name']] = (calls + 1, total + event['dur'] / 1e6)
+
+    if not totals:
+        return
+
+    width = max(len(name) for name in totals)
+    print(f'[pandocmk] {"phase":<{width}}  calls  total (s)   mean (s)')
+    for name, (calls, total) in sorted(totals.items(), key=lambda x: -x[1][1]):
+        print(f'           {name:<{width}}  {calls:>5}  {total:>9.3f}  {total / calls:>9.3f}')
@@ -11,6 +11,8 @@ import yaml
 from pathlib import Path
 #import panflute
 
+from .trace import span
+
 
 # ---------------------------
 # Functions
@@ -18,7 +20,7 @@ from pathlib import Path
 
 def write_metadata(md_fn, style_options):
     yaml_fn = md_fn.parent / (md_fn.stem + '.yaml')
-    with yaml_fn.open('w') as fh:
+    with span('write metadata'), yaml_fn.open('w') as fh:
         yaml.dump(style_options, fh, default_flow_style=False)
     return yaml_fn
 
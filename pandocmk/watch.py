@@ -8,89 +8,167 @@ Code related to monitoring changes to input files
 # ---------------------------
 
 import time
+import shutil
 import datetime
 from pathlib import Path
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
 from .core import build_output
+from .deps import get_dependencies
+from .scheduler import BuildScheduler
+from .continuous import ContinuousLatexmk
 
 
 class MarkdownUpdateHandler(FileSystemEventHandler):
+    '''Rebuild a document when one of its inputs (markdown, bibliography, templates, media sources, etc.) changes'''
 
-    def __init__(self, fn, view, timeit, tex, latexmk, verbose, pandoc_options):
-        self.fn = fn
+    def __init__(self, fn, view, timeit, tex, latexmk, verbose, pandoc_options, cache=True, observer=None, debounce=0.3, draft=False, fmt=False, chunks=False, formats=None, native=False):
         self.fn = fn
         self.timeit = timeit
         self.tex = tex
         self.latexmk = latexmk
         self.verbose = verbose
         self.pandoc_options = pandoc_options
-        self.last_update =  datetime.datetime(1,1,1) # Pick any old datetime
-
-        # Running first time
+        self.cache = cache
+        self.draft = draft
+        self.fmt = fmt
+        self.chunks = chunks
+        self.formats = formats
+        self.native = native
+        self.observer = observer
+        self.deps = set()
+        self.watches = {} # (folder, recursive) -> watchdog watch
+
+        # Without latexmk, we compile with our own driver (as run_latexmk() does)
+        if latexmk and not draft and not native and not shutil.which('latexmk'):
+            print('[pandocmk] Warning! latexmk not found; using the built-in LaTeX driver (--native)')
+            self.native = native = True
+
+        # With --latexmk, builds only write the .tex and a long-running latexmk compiles it incrementally
+        # (with --formats or --native, build_output() compiles the PDF itself)
+        self.continuous = None
+        if latexmk and not draft and not formats and not native:
+            self.continuous = ContinuousLatexmk(self.fn.with_suffix('.tex'), pandoc_options['pdf-engine'], verbose=verbose)
+
+        # Running first time (if it fails, monitor_file() never gets the handler, so we stop latexmk here)
+        self.scheduler = None
         print('RUNNING FIRST TIME WITH EVENT HANDLER')
-        build_output(self.fn, view=view, timeit=self.timeit, tex=self.tex, latexmk=self.latexmk, verbose=self.verbose, pandoc_options=self.pandoc_options)
+        try:
+            build_output(self.fn, view=view, timeit=self.timeit, tex=self.tex, latexmk=self.latexmk, verbose=self.verbose, pandoc_options=self.pandoc_options, cache=self.cache, continuous=self.continuous, draft=self.draft, fmt=self.fmt, chunks=self.chunks, formats=self.formats, native=self.native)
+            self.update_watches()
+        except BaseException:
+            self.stop()
+            raise
+
+        # Later builds run in a worker thread
+        self.scheduler = BuildScheduler(self.rebuild, quiet=debounce, name=self.fn.name, verbose=verbose)
+
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.continuous is not None:
+            self.continuous.stop()
+
+
+    def rebuild(self, cancel):
+        # view=False as we don't need SumatraPDF to steal windows focus every time we save
+        build_output(self.fn, view=False, timeit=self.timeit, tex=self.tex, latexmk=self.latexmk, verbose=self.verbose, pandoc_options=self.pandoc_options, cache=self.cache, cancel=cancel, continuous=self.continuous, draft=self.draft, fmt=self.fmt, chunks=self.chunks, formats=self.formats, native=self.native)
+        self.update_watches()
+        print(f' - File "{self.fn}" rebuilt ({datetime.datetime.now().strftime("%I:%M:%S %p")})')
+
+
+    def update_watches(self):
+        '''Record the inputs of the last build, and watch the folders that contain them'''
+
+        # We skip the {stem}.yaml metadata file as we create it ourselves
+        generated = (self.fn.parent / (self.fn.stem + '.yaml')).resolve()
+        self.deps = {fn.resolve() for fn in get_dependencies(self.pandoc_options, self.fn)} - {generated}
+
+        # Files in missing folders (e.g. tables not yet generated) are watched from their closest existing parent
+        folders = set()
+        for fn in self.deps:
+            folder = fn.parent
+            recursive = False
+            while not folder.is_dir():
+                folder = folder.parent
+                recursive = True
+            folders.add((folder, recursive))
+        folders -= {(folder, False) for folder, recursive in folders if recursive}
+
+        if self.observer is None:
+            return
+
+        for folder, recursive in folders - set(self.watches):
+            if self.verbose:
+                print(f'[pandocmk] watching folder "{folder}" ({recursive=})')
+            self.watches[folder, recursive] = self.observer.schedule(self, str(folder), recursive=recursive)
+
+        for key in set(self.watches) - folders:
+            self.observer.unschedule(self.watches.pop(key))
 
 
     def on_moved(self, event):
-        return
+        # Editors often save by writing a temporary file and renaming it
+        self.on_input_changed(event, event.dest_path)
 
     def on_created(self, event):
-        return
+        self.on_input_changed(event, event.src_path)
 
     def on_deleted(self, event):
         return
 
     def on_modified(self, event):
+        self.on_input_changed(event, event.src_path)
+
+    def on_input_changed(self, event, path):
         if event.is_directory:
             return
 
-        fn_modified = Path(event.src_path)
-
-        #if (fn_modified.suffix != '.md'):
-        #    return
-        
-        #if fn_modified.name != self.fn.name:
-        if fn_modified.suffix != '.md':
-            return # What if another section gets modified?
-
-        t = datetime.datetime.now()
-        delta = t - self.last_update
-
-        # Return if not enough time passed (also prevents duplicate entries)
-        if delta < datetime.timedelta(seconds=0.1):
+        fn_modified = Path(path).resolve()
+        if fn_modified not in self.deps:
             return
-        else:
-            print(delta)
 
-        print(f' - File "{self.fn}" modified ({t.strftime("%I:%M:%S %p")})')
-        # view=False as we don't need SumatraPDF to steal windows focus every time we save
-        #self.last_update = t
-        build_output(self.fn, view=False, timeit=self.timeit, tex=self.tex, latexmk=self.latexmk, verbose=self.verbose, pandoc_options=self.pandoc_options)
-        self.last_update = datetime.datetime.now()
-        #print(event.src_path, event.key, event.event_type)
+        if self.verbose:
+            print(f' - File "{fn_modified.name}" modified ({datetime.datetime.now().strftime("%I:%M:%S %p")})')
+
+        # Duplicate events and bursts of saves are coalesced by the scheduler
+        self.scheduler.request()
 
 
 # ---------------------------
 # Functions
 # ---------------------------
 
-def monitor_file(md_fn, view, timeit, tex, latexmk, verbose, pandoc_options):
+def monitor_file(md_fn, view, timeit, tex, latexmk, verbose, pandoc_options, cache=True, debounce=0.3, draft=False, fmt=False, chunks=False, formats=None, native=False):
 
-    path = '.'
-    print(f'Monitoring file "{md_fn}" in directory {path}')
+    print(f'Monitoring file "{md_fn}" and its inputs')
 
-    event_handler = MarkdownUpdateHandler(fn=md_fn, view=view, timeit=timeit, tex=tex, latexmk=latexmk, verbose=verbose, pandoc_options=pandoc_options)
+    # Being killed (or the terminal closing) stops us as Ctrl+C does, so the cleanup below runs
+    import signal
+    import threading
+    if threading.current_thread() is threading.main_thread():
+        for signum in ('SIGTERM', 'SIGHUP'):
+            if hasattr(signal, signum):
+                signal.signal(getattr(signal, signum), stop_monitor)
 
     observer = Observer(timeout=1)
-    observer.schedule(event_handler, path, recursive=False)
-    observer.start()
+    event_handler = MarkdownUpdateHandler(fn=md_fn, view=view, timeit=timeit, tex=tex, latexmk=latexmk, verbose=verbose, pandoc_options=pandoc_options, cache=cache, observer=observer, debounce=debounce, draft=draft, fmt=fmt, chunks=chunks, formats=formats, native=native)
+
+    # The scheduler and latexmk are stopped even if we leave with an error (e.g. so --retry doesn't start a second latexmk)
     try:
+        observer.start()
         while True:
             time.sleep(0.5)
     except KeyboardInterrupt:
+        pass
+    finally:
         observer.stop()
+        event_handler.stop()
     observer.join()
     print('File monitor stopped')
 
+
+def stop_monitor(signum, frame):
+    raise KeyboardInterrupt
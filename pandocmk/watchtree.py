@@ -0,0 +1,310 @@
+"""
+Code for watching many documents (or whole folders of projects) with a single process
+
+One watchdog observer watches the folders given (recursively, so new documents are found)
+and the folders of inputs that are elsewhere. Each change is mapped to the documents
+that read the changed file, and their rebuilds run in a pool of -jobs- processes:
+
+- A document is built at most once at a time; changes made while it builds
+  trigger a single new build once it ends
+- Builds start after -debounce- seconds without changes to the document
+- Each build runs from the folder of its document (as when building it from there),
+  and reports the inputs it read, so the daemon knows what to watch next
+"""
+
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import time
+import datetime
+import functools
+import threading
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures.process import BrokenProcessPool
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from .batch import run_job, resolve_option_paths
+from .core import build_output
+from .deps import get_dependencies
+from . import trace
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+# Folders skipped when looking for documents (./tmp has the auxiliary files of builds)
+SKIP_FOLDERS = ('tmp', 'node_modules', '__pycache__')
+
+
+def find_folder(fn, folders):
+    '''Return the folder (of -folders-) that contains fn, or None'''
+    for folder in folders:
+        try:
+            fn.relative_to(folder)
+            return folder
+        except ValueError:
+            pass
+    return None
+
+
+def is_document(fn, folder):
+    '''Markdown files with a YAML header are documents (so README.md files etc. are skipped)'''
+    parts = fn.relative_to(folder).parent.parts
+    if fn.suffix != '.md' or any(part.startswith('.') or part in SKIP_FOLDERS for part in parts):
+        return False
+    try:
+        with fn.open(encoding='utf8') as f:
+            return f.readline().rstrip() == '---'
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def find_documents(folder):
+    return sorted(fn for fn in folder.rglob('*.md') if fn.is_file() and is_document(fn, folder))
+
+
+def build_and_list_inputs(md_fn, pandoc_options, inputs, **kwargs):
+    '''build_output() that also records the (resolved) inputs of the document, even if the build fails'''
+    try:
+        build_output(md_fn, pandoc_options=pandoc_options, **kwargs)
+    finally:
+        # We skip the {stem}.yaml metadata file as we create it ourselves
+        generated = (md_fn.parent / (md_fn.stem + '.yaml')).resolve()
+        inputs.extend(str(fn) for fn in (fn.resolve() for fn in get_dependencies(pandoc_options, md_fn)) if fn != generated)
+
+
+def build_document(md_fn, **kwargs):
+    '''Build a document from its folder (in a pool process); return its error (or None), its inputs and trace events'''
+    os.chdir(md_fn.parent)
+    inputs = []
+    error, events = run_job(Path(md_fn.name), build=build_and_list_inputs, inputs=inputs, **kwargs)
+    return error, inputs, events
+
+
+# ---------------------------
+# Classes
+# ---------------------------
+
+class TreeWatcher(FileSystemEventHandler):
+
+    def __init__(self, folders, files, jobs, debounce, build_options, verbose=False):
+        self.folders = [Path(folder).resolve() for folder in folders]
+        self.jobs = jobs
+        self.debounce = debounce
+        self.verbose = verbose
+        # Several documents rebuilding at once shouldn't open viewers. Documents are built from their own
+        # folder (see build_document()), so paths given to Pandoc options must not depend on the current folder
+        pandoc_args = resolve_option_paths(build_options.get('pandoc_args', []))
+        self.build_options = {**build_options, 'view': False, 'pandoc_args': pandoc_args}
+
+        self.cond = threading.Condition()
+        self.inputs = {} # document -> files it read in its last build
+        self.readers = defaultdict(set) # file -> documents that read it
+        self.changed = {} # document -> time of its last change not yet built
+        self.running = set()
+        self.crashed = set() # documents whose last build was lost to a broken pool
+        self.watches = {} # (folder, recursive) -> watchdog watch
+        self.stopped = False
+        self.broken = False
+
+        self.observer = Observer(timeout=1)
+        for md_fn in [Path(fn).resolve() for fn in files] + [fn for folder in self.folders for fn in find_documents(folder)]:
+            self.add_document(md_fn)
+        self.update_watches()
+
+        self.executor = self.start_executor()
+
+
+    def start_executor(self):
+        # Workers are started with "spawn", as forking a process with running threads (the observer's) is unsafe
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context('spawn'))
+
+
+    def restart_executor(self):
+        '''Replace a pool broken by a worker that died (out of memory, a crashing filter, ...)'''
+        print('[pandocmk] Warning! a worker process died; restarting the workers')
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.start_executor()
+        self.broken = False
+
+
+    def add_document(self, md_fn, changed=0):
+        if md_fn in self.inputs:
+            return
+        print(f'[pandocmk] watching document "{md_fn}"')
+        self.set_inputs(md_fn, [md_fn]) # Until its first build tells us the rest
+        self.changed[md_fn] = changed # Documents found at startup are built right away
+
+
+    def set_inputs(self, md_fn, inputs):
+        for fn in self.inputs.get(md_fn, ()):
+            self.readers[fn].discard(md_fn)
+            if not self.readers[fn]:
+                del self.readers[fn]
+        self.inputs[md_fn] = set(inputs)
+        for fn in self.inputs[md_fn]:
+            self.readers[fn].add(md_fn)
+
+
+    def update_watches(self):
+        '''Watch the folders given recursively, plus the folders of the inputs outside them'''
+        wanted = {(folder, True) for folder in self.folders}
+        for fn in self.readers:
+            if find_folder(fn, self.folders) is not None:
+                continue
+            # Files in missing folders (e.g. tables not yet generated) are watched from their closest existing parent
+            folder = fn.parent
+            recursive = False
+            while not folder.is_dir():
+                folder = folder.parent
+                recursive = True
+            wanted.add((folder, recursive))
+        wanted -= {(folder, False) for folder, recursive in wanted if recursive}
+
+        for folder, recursive in wanted - set(self.watches):
+            if self.verbose:
+                print(f'[pandocmk] watching folder "{folder}" ({recursive=})')
+            self.watches[folder, recursive] = self.observer.schedule(self, str(folder), recursive=recursive)
+
+        for key in set(self.watches) - wanted:
+            self.observer.unschedule(self.watches.pop(key))
+
+
+    def on_moved(self, event):
+        # Editors often save by writing a temporary file and renaming it
+        self.on_input_changed(event, event.dest_path)
+
+    def on_created(self, event):
+        self.on_input_changed(event, event.src_path)
+
+    def on_modified(self, event):
+        self.on_input_changed(event, event.src_path)
+
+    def on_input_changed(self, event, path):
+        if event.is_directory:
+            return
+
+        fn = Path(path).resolve()
+        with self.cond:
+            documents = set(self.readers.get(fn, ()))
+            folder = find_folder(fn, self.folders)
+            if not documents and folder is not None and is_document(fn, folder):
+                self.add_document(fn, changed=time.monotonic()) # A new document (that might still be being written)
+            for md_fn in documents:
+                if self.verbose:
+                    print(f' - File "{fn.name}" modified; rebuilding "{md_fn.name}" ({datetime.datetime.now().strftime("%I:%M:%S %p")})')
+                self.changed[md_fn] = time.monotonic()
+            self.cond.notify()
+
+
+    def run(self):
+        '''Dispatch builds until interrupted (Ctrl+C)'''
+        self.observer.start()
+        try:
+            while True:
+                with self.cond:
+                    if self.broken:
+                        self.restart_executor()
+                    ready, wait = self.next_builds()
+                    if not ready:
+                        self.cond.wait(wait)
+                        continue
+                    self.running.update(ready)
+                for md_fn in ready:
+                    try:
+                        future = self.executor.submit(build_document, md_fn, **self.build_options)
+                    except BrokenProcessPool:
+                        # The pool broke since we last checked; build it again once the pool is restarted
+                        with self.cond:
+                            self.broken = True
+                            self.running.discard(md_fn)
+                            self.changed[md_fn] = 0
+                        continue
+                    future.add_done_callback(functools.partial(self.finished, md_fn))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with self.cond:
+                self.stopped = True
+            self.observer.stop()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.observer.join()
+        print('File monitor stopped')
+
+
+    def next_builds(self):
+        '''Documents to build now (changed -debounce- seconds ago, not already building, up to the free workers); and how long to wait otherwise'''
+        now = time.monotonic()
+        ready = []
+        wait = None
+        for md_fn, changed in sorted(self.changed.items(), key=lambda item: item[1]):
+            if md_fn in self.running:
+                continue
+            remaining = changed + self.debounce - now
+            if remaining > 0:
+                wait = remaining if wait is None else min(wait, remaining)
+            elif len(self.running) + len(ready) < self.jobs:
+                ready.append(md_fn)
+        for md_fn in ready:
+            del self.changed[md_fn]
+        return ready, wait
+
+
+    def finished(self, md_fn, future):
+        if future.cancelled():
+            return
+        broken = False
+        try:
+            error, inputs, events = future.result()
+        except BrokenProcessPool:
+            # A worker died, and with it the pool: the builds that were running are lost
+            error, inputs, events = 'a worker process died', [], []
+            broken = True
+        except Exception as e:
+            error, inputs, events = f'{type(e).__name__}: {e}', [], []
+        trace.add_events(events)
+
+        # Documents are built again after a broken pool, unless they were also building when the previous one broke
+        # (as they might be what kills the workers)
+        with self.cond:
+            retry = broken and md_fn not in self.crashed and not self.stopped
+            if broken:
+                self.broken = True
+                self.crashed.add(md_fn)
+            else:
+                self.crashed.discard(md_fn)
+
+        timestamp = datetime.datetime.now().strftime("%I:%M:%S %p")
+        if error is None:
+            print(f' - File "{md_fn}" rebuilt ({timestamp})')
+        elif retry:
+            print(f' - File "{md_fn}" interrupted ({timestamp}): {error}; building it again')
+        else:
+            # Keep watching after a failed build; the next change might fix it
+            print(f' - File "{md_fn}" failed ({timestamp}): {error}')
+
+        with self.cond:
+            self.running.discard(md_fn)
+            if retry:
+                self.changed.setdefault(md_fn, 0)
+            if inputs:
+                self.set_inputs(md_fn, [md_fn] + [Path(fn) for fn in inputs])
+            if not self.stopped:
+                self.update_watches()
+            self.cond.notify()
+
+
+def watch_tree(folders, files, jobs, debounce, build_options):
+    '''Watch several documents and the documents in -folders- (and their subfolders); rebuild them as they change'''
+    watcher = TreeWatcher(folders, files, jobs=jobs, debounce=debounce, build_options=build_options, verbose=build_options.get('verbose', False))
+    print(f'[pandocmk] monitoring {len(watcher.inputs)} documents with {jobs} workers')
+    watcher.run()